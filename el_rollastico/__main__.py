@@ -1,38 +1,281 @@
-from el_rollastico.log import get_logger
+from el_rollastico.log import get_logger, configure as configure_logging
 
 _LOG = get_logger()
 
-from el_rollastico.cluster import Cluster
+from el_rollastico.fleet import Fleet, Target, load_inventory
+from el_rollastico.history import RollHistory, DEFAULT_PATH as HISTORY_PATH, TIMED_PHASES
+from el_rollastico.deadline import RollBudget, DEFAULT_PHASE_TIMEOUTS
+from el_rollastico.gate import AdmissionGate
+from el_rollastico.node import SaltClientPool, HAS_SALT
+from el_rollastico.profiling import Profiler, PROFILERS, PROFILER_CPROFILE
 import click
 
+# Exit code when no cluster failed but some paused at the end of their window with nodes left to roll
+EXIT_PAUSED = 3
+
+
+def client_options(f):
+    '''
+    Decorator adding client tier options to a command.
+    '''
+    f = click.option('--client-batch-size', default=4, type=click.IntRange(min=1),
+                     help='Client nodes to roll at once [4]')(f)
+    f = click.option('--clients/--no-clients', default=False,
+                     help='Roll client (non master, non data) nodes as well, last and concurrently [false]')(f)
+    return f
+
+
+def drain_options(f):
+    '''
+    Decorator adding drain mode options to a command.
+    '''
+    f = click.option('--drain-concurrency', default=None, type=click.INT,
+                     help='Concurrent recoveries per node (and rebalances per cluster) while draining [ES setting]')(f)
+    f = click.option('--drain-ahead/--no-drain-ahead', default=False,
+                     help='With --drain, drain the next data node while the current one is rolled [false]')(f)
+    f = click.option('--drain/--no-drain', default=False,
+                     help='Relocate shards off each data node (allocation exclusion) before rolling it, '
+                          'instead of disabling allocation [false]')(f)
+    return f
+
+
+def budget_options(f):
+    '''
+    Decorator adding time budget options to a command.
+    '''
+    f = click.option('--stall-after', default=600, type=click.INT,
+                     help='Seconds a phase may run (more if history says it usually takes longer) before stall '
+                          'diagnostics are logged [600]')(f)
+    f = click.option('--pause-at-window/--abort-at-window', default=True,
+                     help='When --window runs out, pause before the next node instead of failing the wait '
+                          'in progress [pause]')(f)
+    f = click.option('--phase-timeout', multiple=True, metavar='PHASE=SECS',
+                     help='Deadline for each wait of a phase (%s). Can be given several times. [%s]'
+                          % (', '.join(TIMED_PHASES),
+                             ', '.join('%s=%s' % item for item in sorted(DEFAULT_PHASE_TIMEOUTS.items()))))(f)
+    f = click.option('--window', default=None, type=click.INT,
+                     help='Seconds the whole roll may take (maintenance window) [unlimited]')(f)
+    return f
+
+
+def get_phase_timeouts(phase_timeout, param_hint='--phase-timeout'):
+    '''
+    Parse and validate phase timeouts, before rolling anything.
+
+    :param phase_timeout: PHASE=SECS strings, or a dict from an inventory
+    :raises click.BadParameter: on a malformed item, or a phase without a deadline bounded wait
+    :return: Seconds by phase
+    :rtype: dict
+    '''
+    if isinstance(phase_timeout, dict):
+        items = phase_timeout.items()
+    else:
+        if not isinstance(phase_timeout, (list, tuple)):
+            # A single PHASE=SECS from an inventory
+            phase_timeout = [phase_timeout]
+        items = []
+        for item in phase_timeout:
+            phase, _, secs = str(item).partition('=')
+            items.append((phase, secs))
+
+    phases = {}
+    for phase, secs in items:
+        if phase not in TIMED_PHASES:
+            raise click.BadParameter('Unknown or untimed phase %r, expected one of %s' % (
+                phase, ', '.join(TIMED_PHASES)), param_hint=param_hint)
+        if not str(secs).isdigit():
+            raise click.BadParameter('Expected PHASE=SECS, got %s=%s' % (phase, secs), param_hint=param_hint)
+        phases[phase] = int(secs)
+    return phases
+
+
+def get_budget(window, phase_timeout, pause_at_window, stall_after):
+    '''
+    :param phase_timeout: Seconds by phase, see get_phase_timeouts
+    :type phase_timeout: dict
+    :rtype: RollBudget
+    '''
+    return RollBudget(roll=window, phases=phase_timeout, pause=pause_at_window, stall_after=stall_after)
+
+
+def gate_options(f):
+    '''
+    Decorator adding admission gate options to a command.
+    '''
+    f = click.option('--gate-load', default=None, type=click.FLOAT,
+                     help='Hold while any node\'s 1m load average is over this [off]')(f)
+    f = click.option('--gate-rejections', default=0, type=click.INT,
+                     help='Hold while any node rejects more search/indexing requests than this between checks '
+                          '[0]')(f)
+    f = click.option('--gate-queue', default=50, type=click.INT,
+                     help='Hold while any node has more queued search or indexing requests than this [50]')(f)
+    f = click.option('--gate-disk-percent', default=85, type=click.INT,
+                     help='Hold while any node\'s disk is fuller than this percentage [85]')(f)
+    f = click.option('--gate/--no-gate', default=False,
+                     help='Before each node holding shards, wait until the cluster has the disk and spare '
+                          'capacity to recover it, pausing the roll after the admit phase timeout [false]')(f)
+    return f
+
+
+def get_gate(gate, gate_disk_percent, gate_queue, gate_rejections, gate_load):
+    '''
+    :return: A new gate (they keep per cluster state), or None if disabled
+    :rtype: AdmissionGate
+    '''
+    if not gate:
+        return None
+    return AdmissionGate(disk_percent=gate_disk_percent, queue=gate_queue, rejections=gate_rejections,
+                         load=gate_load)
+
+
+def fleet_options(f):
+    '''
+    Decorator adding multi-cluster options to a command.
+    '''
+    f = click.argument('master_node', nargs=-1)(f)
+    f = click.option('--salt-clients', default=4, type=click.INT,
+                     help='Size of the Salt client pool shared by all clusters [4]')(f)
+    f = click.option('--parallel', default=None, type=click.INT,
+                     help='Maximum clusters to roll at once [all]')(f)
+    f = click.option('--inventory', type=click.Path(exists=True, dir_okay=False),
+                     help='YAML inventory of clusters to roll, with per-cluster options.')(f)
+    return f
+
+
+def get_targets(master_node, inventory, opts):
+    '''
+    :param opts: The command's roll options; inventory entries may only override these
+    :type opts: dict
+    :return: Fleet targets from MASTER_NODE arguments and the inventory
+    :rtype: list
+    '''
+    targets = [Target(m, m) for m in master_node]
+    if inventory:
+        try:
+            targets.extend(load_inventory(inventory, roll_opts=opts))
+        except (ImportError, ValueError) as e:
+            raise click.BadParameter(str(e), param_hint='--inventory')
+        ctx = click.get_current_context()
+        params = dict((p.name, p) for p in ctx.command.params)
+        for target in targets:
+            param_hint = '--inventory (cluster %s)' % target.name
+            if 'phase_timeout' in target.opts:
+                target.opts['phase_timeout'] = get_phase_timeouts(target.opts['phase_timeout'], param_hint=param_hint)
+            # Check the other options like the command line would, eg --client-batch-size's range
+            for key, value in target.opts.items():
+                param = params.get(key)
+                if param is None or param.multiple or value is None:
+                    continue
+                try:
+                    target.opts[key] = param.type.convert(value, param, ctx)
+                except click.BadParameter as e:
+                    raise click.BadParameter('%s: %s' % (key, e.message), param_hint=param_hint)
+    if not targets:
+        raise click.UsageError('Specify at least one MASTER_NODE or an --inventory.')
+
+    names = [t.name for t in targets]
+    dupes = sorted(set(n for n in names if names.count(n) > 1))
+    if dupes:
+        raise click.UsageError('Clusters given more than once: %s' % ', '.join(dupes))
+    return targets
+
+
+def run_fleet(targets, roll, history, history_db, parallel, salt_clients, **opts):
+    '''
+    Roll targets concurrently, failing the command if any cluster failed, and exiting with EXIT_PAUSED if any
+    paused.
+    '''
+    fleet = Fleet(
+        targets,
+        history=get_history(history, history_db),
+        salt_pool=HAS_SALT and SaltClientPool(salt_clients) or None,
+        max_parallel=parallel,
+    )
+    if not fleet.run(roll, **opts):
+        raise click.ClickException('Roll failed on: %s' % ', '.join(sorted(fleet.errors)))
+    if fleet.paused:
+        _LOG.warning('Roll paused with nodes left to roll on: %s', ', '.join(fleet.paused))
+        click.get_current_context().exit(EXIT_PAUSED)
+
+
+def history_options(f):
+    '''
+    Decorator adding roll history options to a command.
+    '''
+    f = click.option('--history-db', default=HISTORY_PATH, type=click.Path(dir_okay=False),
+                     help='SQLite database of past roll durations [%s]' % HISTORY_PATH)(f)
+    f = click.option('--history/--no-history', default=True,
+                     help='Use past roll durations for adaptive timeouts, ETAs and anomaly warnings [true]')(f)
+    return f
+
+
+def get_history(history, history_db):
+    '''
+    :return: RollHistory if enabled, else None
+    :rtype: RollHistory
+    '''
+    if not history:
+        return
+    return RollHistory(history_db)
+
 
 @click.group()
-def cli():
-    pass
+@click.option('--profile', type=click.Choice(PROFILERS), default=None,
+              help='Profile the command with cProfile or a sampling profiler, and report ES and Salt call counts '
+                   'and timings')
+@click.option('--profile-output', type=click.Path(dir_okay=False), default=None,
+              help='Write the profile report here (implies --profile %s), with the raw profile next to it '
+                   '[logged]' % PROFILER_CPROFILE)
+@click.option('--log-level', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR']), default=None,
+              help='Level of el_rollastico\'s logs [config.LOG_LEVEL]')
+@click.option('--log-format', type=click.Choice(['standard', 'json']), default=None,
+              help='Console log format [config.LOG_FORMAT]')
+@click.pass_context
+def cli(ctx, profile, profile_output, log_level, log_format):
+    if log_level or log_format:
+        configure_logging(level=log_level, fmt=log_format)
+    if profile_output and not profile:
+        profile = PROFILER_CPROFILE
+    if profile:
+        profiler = Profiler(profile, output=profile_output)
+        profiler.start()
+        ctx.call_on_close(profiler.stop)
 
 
 @cli.command()
-@click.argument('master_node', nargs=1)
+@fleet_options
 @click.option('--masters/--no-masters', default=False, help='Restart master nodes as well [false]')
 @click.option('--datas/--no-datas', default=True, help='Restart data nodes [true]')
+@client_options
+@drain_options
+@budget_options
+@gate_options
 @click.option('--kill-at-heap', default=85, help='Heap used percentage threshold to restart that node [85]',
               type=click.INT)
 @click.option('--highstate/--no-highstate', default=False,
               help='Run a highstate on each node prior to rolling. ES restart from a highstate is taken into account.')
-def restart(master_node, kill_at_heap, masters, datas, highstate):
+@history_options
+def restart(master_node, inventory, parallel, salt_clients, kill_at_heap, masters, datas, clients, client_batch_size,
+            drain, drain_ahead, drain_concurrency, window, phase_timeout, pause_at_window, stall_after, gate,
+            gate_disk_percent, gate_queue, gate_rejections, gate_load, highstate, history, history_db):
     '''
-    Rolling restart of cluster.
+    Rolling restart of cluster(s).
 
     MASTER_NODE is the initial node to query to get the list of master nodes to connect to. El_Rollastico will connect to all master nodes to avoid relying on one to be up for the roll procedure.
 
+    Several MASTER_NODEs (one per cluster) and/or an --inventory may be given to roll several clusters concurrently.
+    Options given here are the defaults for every cluster; the inventory can override them per cluster.
+
     \b
     This will:
       - Collect and order the nodes to roll.
-        If you opted to include master nodes, they are always done first.
+        If you opted to include master nodes, they are always done first,
+        except the elected master, which is always rolled last.
       - Wait until cluster is in green health
       - For each node from #1 above
         If node's heap used percentage is over kill-at-heap:
         * Disable cluster allocation
+          (with --drain: exclude the node from allocation and wait until it holds no shards)
         * Ping node through Salt to verify connectivity
         * Shutdown node
         * Wait for ES to die for 2m.
@@ -42,39 +285,83 @@ def restart(master_node, kill_at_heap, masters, datas, highstate):
           If the highstate fails, fail El_Rollastico.
         * Start elasticsearch service through Salt
         * Wait until node joins cluster with an uptime within 120s.
-        * Enable allocation
+        * Enable allocation (with --drain: lift the node's exclusion)
         * Wait until cluster is in green health
+      - If --clients was specified, restart client nodes over kill-at-heap
+        --client-batch-size at a time, waiting only for them to rejoin.
+
+    Durations of each phase are recorded to --history-db and used on later rolls to adapt timeouts and poll
+    intervals, estimate the time remaining and warn when a node is much slower than its own history.
+
+    Every wait can be bounded with --phase-timeout and the whole roll with --window. By default the roll pauses
+    before a node that would not fit in the window, and the command then exits with code 3. Phases running past
+    --stall-after get stall diagnostics (unassigned shards and why) logged.
+
+    With --gate, the roll holds before each node holding shards while any node is over the --gate-* thresholds
+    (disk, queued or rejected search/indexing requests, load), so recoveries don't compete with a saturated
+    cluster. A hold past the admit phase timeout (an hour by default) pauses the roll.
     '''
-    _LOG.info('Rolling restart with master_node=%s kill_at_heap=%s', master_node, kill_at_heap)
+    opts = dict(
+        masters=masters, datas=datas, clients=clients, client_batch_size=client_batch_size,
+        drain=drain, drain_ahead=drain_ahead, drain_concurrency=drain_concurrency,
+        window=window, phase_timeout=get_phase_timeouts(phase_timeout), pause_at_window=pause_at_window,
+        stall_after=stall_after,
+        gate=gate, gate_disk_percent=gate_disk_percent, gate_queue=gate_queue, gate_rejections=gate_rejections,
+        gate_load=gate_load,
+        kill_at_heap=kill_at_heap, highstate=highstate,
+    )
+    targets = get_targets(master_node, inventory, opts)
+    _LOG.info('Rolling restart with targets=%s kill_at_heap=%s', targets, kill_at_heap)
 
-    cluster = Cluster(master_node)
-    _LOG.info('Cluster status: %s', cluster.status())
-    cluster.rolling_restart(master=masters, data=datas, heap_used_percent_threshold=kill_at_heap, highstate=highstate)
+    def roll(cluster, masters, datas, clients, client_batch_size, drain, drain_ahead, drain_concurrency,
+             window, phase_timeout, pause_at_window, stall_after, gate, gate_disk_percent, gate_queue,
+             gate_rejections, gate_load, kill_at_heap, highstate):
+        cluster.rolling_restart(master=masters, data=datas, clients=clients, client_batch_size=client_batch_size,
+                                drain=drain, drain_ahead=drain_ahead, drain_concurrency=drain_concurrency,
+                                budget=get_budget(window, phase_timeout, pause_at_window, stall_after),
+                                gate=get_gate(gate, gate_disk_percent, gate_queue, gate_rejections, gate_load),
+                                heap_used_percent_threshold=kill_at_heap, highstate=highstate)
+
+    run_fleet(targets, roll, history, history_db, parallel, salt_clients, **opts)
 
 
 @cli.command()
-@click.argument('master_node', nargs=1)
+@fleet_options
 @click.option('--masters/--no-masters', default=False, help='Restart master nodes as well [false]')
 @click.option('--datas/--no-datas', default=True, help='Restart data nodes [true]')
+@client_options
+@drain_options
+@budget_options
+@gate_options
 @click.option('--minimum-version', default='1.7.1', help='Minimum version to upgrade to [1.7.1]')
 @click.option('--hold', is_flag=True, default=False, help='Override ''held'' elasticsearch package mark, and re-mark as ''held'' once upgraded. '
               'Cannot be combined with the --unhold flag. This works on Debian based systems only.')
 @click.option('--unhold', is_flag=True, default=False, help='Override ''held'' elasticsearch package mark, and ''unhold'' package once upgraded. '
               'Cannot be combined with the --hold flag. This works on Debian based systems only.')
-def upgrade(master_node, masters, datas, minimum_version, hold, unhold):
+@history_options
+def upgrade(master_node, inventory, parallel, salt_clients, masters, datas, clients, client_batch_size,
+            drain, drain_ahead, drain_concurrency, window, phase_timeout, pause_at_window, stall_after, gate,
+            gate_disk_percent, gate_queue, gate_rejections, gate_load, minimum_version, hold, unhold, history,
+            history_db):
     '''
-    Rolling upgrade of cluster.
+    Rolling upgrade of cluster(s).
 
     MASTER_NODE is the initial node to query to get the list of master nodes to connect to. El_Rollastico will connect to all master nodes to avoid relying on one to be up for the roll procedure.
 
+    Several MASTER_NODEs (one per cluster) and/or an --inventory may be given to roll several clusters concurrently.
+    Options given here are the defaults for every cluster; the inventory can override them per cluster
+    (use hold_package: true/false for --hold/--unhold).
+
     \b
     This will:
       - Collect and order the nodes to roll.
-        If you opted to include master nodes, they are always done first.
+        If you opted to include master nodes, they are always done first,
+        except the elected master, which is always rolled last.
       - Wait until cluster is in green health
       - For each node from #1 above
         If node's ES version is under minimum_version:
         * Disable cluster allocation
+          (with --drain: exclude the node from allocation and wait until it holds no shards)
         * Ping node through Salt to verify connectivity
         * Run a Salt highstate
         * Check for an available upgrade on the Elasticsearch package, if so:
@@ -85,8 +372,21 @@ def upgrade(master_node, masters, datas, minimum_version, hold, unhold):
         * If ES was stopped at any point in this:
           - Start elasticsearch service if it's not already started
           - Wait until node joins cluster with an uptime within 120s.
-        * Enable allocation
+        * Enable allocation (with --drain: lift the node's exclusion)
         * Wait until cluster is in green health
+      - If --clients was specified, upgrade client nodes under minimum_version
+        --client-batch-size at a time, waiting only for them to rejoin.
+
+    Durations of each phase are recorded to --history-db and used on later rolls to adapt timeouts and poll
+    intervals, estimate the time remaining and warn when a node is much slower than its own history.
+
+    Every wait can be bounded with --phase-timeout and the whole roll with --window. By default the roll pauses
+    before a node that would not fit in the window, and the command then exits with code 3. Phases running past
+    --stall-after get stall diagnostics (unassigned shards and why) logged.
+
+    With --gate, the roll holds before each node holding shards while any node is over the --gate-* thresholds
+    (disk, queued or rejected search/indexing requests, load), so recoveries don't compete with a saturated
+    cluster. A hold past the admit phase timeout (an hour by default) pauses the roll.
     '''
     # Assert that incompatible arguments are not specified, and determine hold policy
     assert not (hold and unhold)
@@ -96,11 +396,28 @@ def upgrade(master_node, masters, datas, minimum_version, hold, unhold):
     elif unhold:
         hold_package = False
     
-    _LOG.info('Rolling upgrade with master_node=%s and minimum_version=%s, hold_package=%s', master_node, minimum_version, hold_package)
-    
-    cluster = Cluster(master_node)
-    _LOG.info('Cluster status: %s', cluster.status())
-    cluster.rolling_upgrade(master=masters, data=datas, minimum_version=minimum_version, hold_package=hold_package)
+    opts = dict(
+        masters=masters, datas=datas, clients=clients, client_batch_size=client_batch_size,
+        drain=drain, drain_ahead=drain_ahead, drain_concurrency=drain_concurrency,
+        window=window, phase_timeout=get_phase_timeouts(phase_timeout), pause_at_window=pause_at_window,
+        stall_after=stall_after,
+        gate=gate, gate_disk_percent=gate_disk_percent, gate_queue=gate_queue, gate_rejections=gate_rejections,
+        gate_load=gate_load,
+        minimum_version=minimum_version, hold_package=hold_package,
+    )
+    targets = get_targets(master_node, inventory, opts)
+    _LOG.info('Rolling upgrade with targets=%s and minimum_version=%s, hold_package=%s', targets, minimum_version, hold_package)
+
+    def roll(cluster, masters, datas, clients, client_batch_size, drain, drain_ahead, drain_concurrency,
+             window, phase_timeout, pause_at_window, stall_after, gate, gate_disk_percent, gate_queue,
+             gate_rejections, gate_load, minimum_version, hold_package):
+        cluster.rolling_upgrade(master=masters, data=datas, clients=clients, client_batch_size=client_batch_size,
+                                drain=drain, drain_ahead=drain_ahead, drain_concurrency=drain_concurrency,
+                                budget=get_budget(window, phase_timeout, pause_at_window, stall_after),
+                                gate=get_gate(gate, gate_disk_percent, gate_queue, gate_rejections, gate_load),
+                                minimum_version=minimum_version, hold_package=hold_package)
+
+    run_fleet(targets, roll, history, history_db, parallel, salt_clients, **opts)
 
     
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+from el_rollastico import profiling
+import elasticsearch
+from elasticsearch.client import _normalize_hosts
+from elasticsearch.connection import Urllib3HttpConnection
+import socket
+
+# Per-host connection pool size. Polling, watchers and concurrent rolls share one client.
+DEFAULT_MAXSIZE = 25
+# Timeout (secs) for short polling calls (cat, nodes info/stats, settings)
+DEFAULT_POLL_TIMEOUT = 10
+# Timeout (secs) for long-poll calls (eg cluster health with wait_for_status)
+DEFAULT_LONG_POLL_TIMEOUT = 60
+
+# TCP keepalive: start probing after 60s idle, every 15s, give up after 4 failures
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_COUNT = 4
+
+
+def keepalive_socket_options():
+    '''
+    Socket options enabling TCP keepalive (with tuning where the platform supports it).
+
+    :rtype: list
+    '''
+    opts = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    for name, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE),
+                        ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                        ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, name):
+            opts.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return opts
+
+
+class KeepAliveConnection(Urllib3HttpConnection):
+    '''
+    Urllib3 connection with HTTP and TCP keepalive enabled on its pool.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.setdefault('connection', 'keep-alive')
+        kwargs['headers'] = headers
+        super(KeepAliveConnection, self).__init__(*args, **kwargs)
+
+        # New sockets opened by this pool get keepalive set
+        self.pool.conn_kw['socket_options'] = keepalive_socket_options()
+
+
+class TimedTransport(elasticsearch.Transport):
+    '''
+    Transport timing each request for --profile's call stats.
+    '''
+
+    def perform_request(self, method, url, *args, **kwargs):
+        with profiling.timed('es', '%s %s' % (method, url.split('?', 1)[0])):
+            return super(TimedTransport, self).perform_request(method, url, *args, **kwargs)
+
+
+def supports_http_compress():
+    '''
+    :return: If installed elasticsearch client supports http_compress
+    :rtype: bool
+    '''
+    return elasticsearch.VERSION >= (6, 3, 0)
+
+
+def build_client(hosts, timeout=None, sniff=False, maxsize=DEFAULT_MAXSIZE, compress=True):
+    '''
+    Build an Elasticsearch client with a sized, keepalive-tuned connection pool.
+
+    The client is safe to share across threads; each host gets its own pool of up to maxsize connections.
+
+    :param hosts: List of hosts
+    :type hosts: list
+    :param timeout: Default client timeout
+    :type timeout: int
+    :param sniff: Enable ES sniffer
+    :type sniff: bool
+    :param maxsize: Connections per host
+    :type maxsize: int
+    :param compress: Enable HTTP compression (if supported by client)
+    :type compress: bool
+    :rtype: elasticsearch.Elasticsearch
+    '''
+    es_opts = dict(
+        timeout=timeout,
+        retry_on_timeout=True,
+        connection_class=KeepAliveConnection,
+        transport_class=TimedTransport,
+        maxsize=maxsize,
+    )
+    if compress:
+        if supports_http_compress():
+            es_opts['http_compress'] = True
+        else:
+            _LOG.debug('elasticsearch client %s does not support http_compress', elasticsearch.__versionstr__)
+    if sniff:
+        es_opts.update(dict(
+            sniff_on_start=True,
+            sniff_on_connection_fail=True,
+        ))
+
+    return elasticsearch.Elasticsearch(hosts, **es_opts)
+
+
+def master_host_info_callback(node_info, host):
+    '''
+    Sniffer host_info_callback keeping master eligible nodes only.
+
+    :param node_info: Node entry from nodes info
+    :type node_info: dict
+    :param host: Host the sniffer would connect to
+    :type host: dict
+    :return: host, or None to skip the node
+    :rtype: dict
+    '''
+    roles = node_info.get('roles')
+    if roles is not None:
+        # 5.x+
+        return 'master' in roles and host or None
+    # 1.x/2.x only report node.master when it was set
+    if str(node_info.get('attributes', {}).get('master', 'true')).lower() == 'false':
+        return None
+    return host
+
+
+def set_hosts(es, hosts, masters_only=False):
+    '''
+    Point an existing client at a new list of hosts, keeping its transport and settings.
+
+    :param es: Client
+    :type es: elasticsearch.Elasticsearch
+    :param hosts: List of hosts
+    :type hosts: list
+    :param masters_only: hosts are the master eligible nodes. If the client sniffs, later sniffs keep to master
+                         eligible nodes as well instead of replacing hosts with every node.
+    :type masters_only: bool
+    '''
+    hosts = _normalize_hosts(hosts)
+    transport = es.transport
+    # Connections to hosts already known are kept, along with their pools
+    transport.set_connections(hosts)
+    transport.hosts = hosts
+    # Sniff through the new hosts rather than the initial ones
+    transport.seed_connections = transport.connection_pool.connections[:]
+    if masters_only:
+        transport.host_info_callback = master_host_info_callback
@@ -1,21 +1,41 @@
-from el_rollastico.log import get_logger
+from el_rollastico.log import get_logger, Payload
 
 _LOG = get_logger()
 
 from el_rollastico.node import Node, NodeSaltOps, HAS_SALT
-
+from el_rollastico import history as rh
+from el_rollastico import client
+from el_rollastico.watcher import ClusterWatcher
+from el_rollastico.util import run_concurrently
+from el_rollastico.deadline import Deadline, RollBudget, Watchdog
+
+from elasticsearch import TransportError
+from contextlib import contextmanager
 from distutils.version import LooseVersion
-import elasticsearch
+from datetime import timedelta
+import threading
 import time
 import types
 from os import linesep as LINESEP
 from json import dumps as jsondumps
+
+SETTING_EXCLUDE_NAME = 'cluster.routing.allocation.exclude._name'
+SETTING_NODE_CONCURRENT_RECOVERIES = 'cluster.routing.allocation.node_concurrent_recoveries'
+SETTING_CLUSTER_CONCURRENT_REBALANCE = 'cluster.routing.allocation.cluster_concurrent_rebalance'
+# ES defaults, used where a transient setting can't be reset (ES < 5)
+SETTING_DEFAULTS = {
+    SETTING_EXCLUDE_NAME: '',
+    SETTING_NODE_CONCURRENT_RECOVERIES: 2,
+    SETTING_CLUSTER_CONCURRENT_REBALANCE: 2,
+}
 class Cluster(object):
     '''
     Represents an ES cluster.
     '''
 
-    def __init__(self, hosts, timeout=None, sniff=False, connect_to_all_masters=True):
+    def __init__(self, hosts, timeout=None, sniff=False, connect_to_all_masters=True, history=None, salt_pool=None,
+                 maxsize=client.DEFAULT_MAXSIZE, poll_timeout=client.DEFAULT_POLL_TIMEOUT,
+                 long_poll_timeout=client.DEFAULT_LONG_POLL_TIMEOUT):
         '''
         Init
 
@@ -27,31 +47,221 @@ class Cluster(object):
         :type sniff: bool
         :param connect_to_all_masters: Once connected, get a list of all master nodes and connect to all of them.
         :type connect_to_all_masters: bool
+        :param history: Roll history used for adaptive timeouts, ETAs and anomaly warnings
+        :type history: el_rollastico.history.RollHistory
+        :param salt_pool: Salt client pool to share with other clusters. If None, each node op gets its own client.
+        :type salt_pool: el_rollastico.node.SaltClientPool
+        :param maxsize: Connections per host in the client pool
+        :type maxsize: int
+        :param poll_timeout: Request timeout (secs) for short polling calls
+        :type poll_timeout: int
+        :param long_poll_timeout: Request timeout (secs) for long-poll health calls
+        :type long_poll_timeout: int
         '''
         if isinstance(hosts, types.StringTypes):
             hosts = hosts.split(',')
         self.hosts = hosts
-
-        es_opts = dict(
-            timeout=timeout,
-            retry_on_timeout=True,
-        )
-        if sniff:
-            es_opts.update(dict(
-                sniff_on_start=True,
-                sniff_on_connection_fail=True,
-            ))
-
-        self.es = elasticsearch.Elasticsearch(self.hosts, **es_opts)
+        self.history = history
+        self.poll_timeout = poll_timeout
+        self.long_poll_timeout = long_poll_timeout
+        self.salt_pool = salt_pool
+        self.watcher = None
+        self._name = None
+        # Nodes excluded from allocation before the roll started, kept excluded alongside the roll's own
+        self._base_exclusions = []
+
+        # Time budgets, set per roll by rolling_helper
+        self.budget = RollBudget()
+        self.roll_deadline = Deadline(name='roll')
+        self._active_phases = {}
+        self._phase_lock = threading.Lock()
+        # Set to make the roll pause at the next node boundary (eg on Ctrl-C)
+        self._stop_requested = threading.Event()
+
+        # Roll progress, read by el_rollastico.fleet for combined reports
+        self.progress = dict(state='idle', total=0, done=0, node=None)
+
+        # One client for the whole roll; it's thread-safe and keeps its pools when hosts change.
+        self.es = client.build_client(self.hosts, timeout=timeout, sniff=sniff, maxsize=maxsize)
 
         if connect_to_all_masters:
             _LOG.info('Connecting to all master nodes')
             master_hosts = list()
             for node in self.iter_nodes():
                 if node.is_master:
-                    master_hosts.append(node.publish_host)
+                    if node.publish_host:
+                        master_hosts.append(node.publish_host)
+                    else:
+                        _LOG.warning('Skipping master node %s without a usable http address', node)
             _LOG.debug('master_hosts=%s', master_hosts)
-            self.es = elasticsearch.Elasticsearch(master_hosts, **es_opts)
+            if master_hosts:
+                client.set_hosts(self.es, master_hosts, masters_only=True)
+            else:
+                _LOG.warning('No master node addresses found, staying connected to %s', self.hosts)
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.name}>'.format(self)
+
+    @property
+    def name(self):
+        '''
+        :return: Cluster name
+        :rtype: str
+        '''
+        if not self._name:
+            self._name = self.es.cluster.health(request_timeout=self.poll_timeout)['cluster_name']
+        return self._name
+
+    @contextmanager
+    def phase(self, node, phase):
+        '''
+        Times a roll phase on node, recording it to history (if any) and making it visible to the watchdog.
+
+        :param node: Node
+        :type node: Node
+        :param phase: Phase name, see el_rollastico.history
+        :type phase: str
+        '''
+        key = (node.name, phase)
+        with self._phase_lock:
+            self._active_phases[key] = (node, time.time())
+        try:
+            if not self.history:
+                yield
+                return
+            with self.history.phase(self.name, node.name, phase):
+                yield
+        finally:
+            with self._phase_lock:
+                self._active_phases.pop(key, None)
+
+    def active_phases(self):
+        '''
+        :return: (node, phase, started) for phases currently running
+        :rtype: list
+        '''
+        with self._phase_lock:
+            return [(node, phase, started) for (_, phase), (node, started) in self._active_phases.items()]
+
+    def deadline_for(self, phase):
+        '''
+        Deadline for a wait of phase, from the roll budget. Bounded by the roll's deadline unless the roll pauses
+        at node boundaries instead.
+
+        :param phase: Phase name, see el_rollastico.history
+        :type phase: str
+        :rtype: Deadline
+        '''
+        parent = None
+        if not self.budget.pause:
+            parent = self.roll_deadline
+        return Deadline(self.budget.phases.get(phase), parent=parent, name=phase)
+
+    def stall_diagnostics(self):
+        '''
+        Describe why the cluster may be stuck: health, shards that aren't started (with reasons where the ES version
+        reports them) and an allocation explanation (ES 5+).
+
+        :rtype: str
+        '''
+        lines = []
+        health = self.es.cluster.health(request_timeout=self.poll_timeout)
+        lines.append('health: status=%(status)s nodes=%(number_of_nodes)s relocating=%(relocating_shards)s '
+                     'initializing=%(initializing_shards)s unassigned=%(unassigned_shards)s' % health)
+
+        try:
+            raw = self.es.cat.shards(h='index,shard,prirep,state,node,unassigned.reason',
+                                     request_timeout=self.poll_timeout)
+        except Exception:
+            # unassigned.reason needs ES 1.7+
+            raw = self.es.cat.shards(h='index,shard,prirep,state,node', request_timeout=self.poll_timeout)
+        pending = [l.strip() for l in raw.splitlines() if l.split()[3:4] != ['STARTED']]
+        for line in pending[:20]:
+            lines.append('shard: %s' % line)
+        if len(pending) > 20:
+            lines.append('... and %d more shards not started' % (len(pending) - 20))
+
+        if health.get('unassigned_shards'):
+            try:
+                explain = self.es.cluster.allocation_explain(request_timeout=self.poll_timeout)
+                lines.append('allocation explain: %s[%s] %s: %s' % (
+                    explain.get('index'), explain.get('shard'),
+                    explain.get('unassigned_info', {}).get('reason'),
+                    explain.get('allocate_explanation') or explain.get('can_allocate')))
+            except Exception as e:
+                lines.append('allocation explain unavailable: %r' % e)
+        return LINESEP.join(lines)
+
+    def _wait_for_view(self, predicate, deadline):
+        '''
+        Watcher wait_for bounded by deadline, only accepting views refreshed after the wait started.
+
+        :raises DeadlineExceeded: if deadline expires first
+        '''
+        started = time.time()
+        while True:
+            ret = self.watcher.wait_for(predicate, timeout=deadline.remaining(), fresh_after=started)
+            if ret:
+                return ret
+            deadline.check()
+
+    def phase_timeout(self, node, phase, default, minimum=None):
+        '''
+        Timeout (secs) for a phase on node, adapted from history when available.
+
+        :rtype: float
+        '''
+        if not self.history:
+            return default
+        return self.history.timeout(self.name, node.name, phase, default, minimum=minimum)
+
+    def phase_poll_interval(self, node, phase, default):
+        '''
+        Poll interval (secs) for a phase on node, adapted from history when available.
+
+        :rtype: float
+        '''
+        if not self.history:
+            return default
+        return self.history.poll_interval(self.name, node.name, phase, default)
+
+    def service_wait_opts(self, node, phase, default_check_every=10, default_timeout_iterations=6, minimum=30):
+        '''
+        Arguments for NodeSaltOps.wait_for_service_status, adapted from history when available and bounded by
+        the roll budget's deadline for phase. The shutdown timeout is never lowered below its default.
+
+        :rtype: dict
+        '''
+        default_timeout = default_check_every * default_timeout_iterations
+        if phase == rh.PHASE_SHUTDOWN:
+            # A shutdown timeout ends in a killall java, so history may only make it longer
+            minimum = max(minimum, default_timeout)
+        check_every = self.phase_poll_interval(node, phase, default_check_every)
+        timeout = self.phase_timeout(node, phase, default_timeout, minimum=minimum)
+        return dict(
+            check_every=check_every,
+            timeout_iterations=max(1, int(round(timeout / float(check_every)))),
+            deadline=self.deadline_for(phase),
+        )
+
+    def estimate_remaining(self, nodes):
+        '''
+        Estimated time to roll nodes, from history.
+
+        :param nodes: Nodes left to roll
+        :type nodes: list
+        :return: Estimate, or None if there is not enough history
+        :rtype: timedelta
+        '''
+        if not self.history:
+            return
+        total = 0
+        for node in nodes:
+            est = self.history.estimate(self.name, node.name, rh.PHASE_NODE)
+            if est is None:
+                return
+            total += est
+        return timedelta(seconds=int(total))
 
     def put_settings(self, settings, persistent=True):
         '''
@@ -65,7 +275,7 @@ class Cluster(object):
         :rtype: bool
         '''
         cat = persistent and 'persistent' or 'transient'
-        ret = self.es.cluster.put_settings({cat: settings})
+        ret = self.es.cluster.put_settings({cat: settings}, request_timeout=self.poll_timeout)
         return ret['acknowledged'] is True
 
     def disable_allocation(self, v2=False):
@@ -102,6 +312,181 @@ class Cluster(object):
                 # 'cluster.routing.allocation.node': 'all',
             })
 
+    def exclude_nodes(self, names):
+        '''
+        Exclude nodes from shard allocation (transiently), so their shards relocate away. Nodes that were excluded
+        before the roll started stay excluded.
+
+        :param names: Node names. Empty to lift the roll's exclusions.
+        :type names: list
+        :return: Success
+        :rtype: bool
+        '''
+        _LOG.info('Excluding nodes from allocation: %s', names)
+        excluded = list(self._base_exclusions)
+        excluded.extend(n for n in names if n not in excluded)
+        return self.put_settings({
+            SETTING_EXCLUDE_NAME: ','.join(excluded),
+        }, persistent=False)
+
+    def set_recovery_concurrency(self, concurrency):
+        '''
+        Bound concurrent shard recoveries/relocations (transiently).
+
+        :param concurrency: Concurrent recoveries per node and rebalances per cluster
+        :type concurrency: int
+        :return: Success
+        :rtype: bool
+        '''
+        _LOG.info('Setting recovery concurrency to %s', concurrency)
+        return self.put_settings({
+            SETTING_NODE_CONCURRENT_RECOVERIES: concurrency,
+            SETTING_CLUSTER_CONCURRENT_REBALANCE: concurrency,
+        }, persistent=False)
+
+    def get_settings(self, keys):
+        '''
+        :param keys: Flat setting names
+        :type keys: list
+        :return: Current transient and persistent values for keys (missing if unset), as two dicts
+        :rtype: tuple
+        '''
+        ret = self.es.cluster.get_settings(flat_settings=True, request_timeout=self.poll_timeout)
+        transient, persistent = ret.get('transient', {}), ret.get('persistent', {})
+        return (dict((k, transient[k]) for k in keys if k in transient),
+                dict((k, persistent[k]) for k in keys if k in persistent))
+
+    def restore_transient_settings(self, keys, transient, persistent):
+        '''
+        Put transient settings back as they were (see get_settings). Keys that weren't set are reset, so persistent
+        values apply again; ES < 5 can't reset a transient setting, so those get the persistent or default value.
+
+        :param keys: Flat setting names
+        :type keys: list
+        :param transient: Previous transient values
+        :type transient: dict
+        :param persistent: Previous persistent values
+        :type persistent: dict
+        :return: Success
+        :rtype: bool
+        '''
+        settings = dict((k, transient.get(k)) for k in keys)
+        _LOG.info('Restoring transient settings: %s', settings)
+        try:
+            return self.put_settings(settings, persistent=False)
+        except TransportError as e:
+            if all(v is not None for v in settings.values()):
+                raise
+            _LOG.warning('Could not reset transient settings (%r), setting them to persistent or default values', e)
+            return self.put_settings(dict(
+                (k, transient[k] if k in transient else persistent.get(k, SETTING_DEFAULTS.get(k))) for k in keys
+            ), persistent=False)
+
+    def shards_per_node(self):
+        '''
+        Shard count per node (_cat/allocation).
+
+        :return: Shard count by node name
+        :rtype: dict
+        '''
+        raw = self.es.cat.allocation(h='shards,node', request_timeout=self.poll_timeout)
+        ret = {}
+        for line in raw.splitlines():
+            parts = line.split(None, 1)
+            # Unassigned shards are reported as a pseudo node named UNASSIGNED
+            if len(parts) == 2 and parts[0].isdigit() and parts[1].strip() != 'UNASSIGNED':
+                ret[parts[1].strip()] = int(parts[0])
+        return ret
+
+    def disk_percent_per_node(self):
+        '''
+        Disk used percentage per data node (_cat/allocation).
+
+        :return: Disk used percentage by node name
+        :rtype: dict
+        '''
+        raw = self.es.cat.allocation(h='disk.percent,node', request_timeout=self.poll_timeout)
+        ret = {}
+        for line in raw.splitlines():
+            parts = line.split(None, 1)
+            # The UNASSIGNED pseudo node has no disk columns
+            if len(parts) == 2 and parts[0].isdigit():
+                ret[parts[1].strip()] = int(parts[0])
+        return ret
+
+    def wait_for_admission(self, gate, nodes, deadline=None):
+        '''
+        Loops around until gate admits another node, ie the cluster has the disk and spare capacity to recover its
+        shards quickly. Gives up once the roll should pause before nodes (see _should_pause).
+
+        :param gate: Admission gate
+        :type gate: el_rollastico.gate.AdmissionGate
+        :param nodes: Nodes waiting to be admitted
+        :type nodes: list
+        :param deadline: Deadline for the wait. Defaults to the roll budget's for the admit phase.
+        :type deadline: Deadline
+        :return: True once admitted, False if the roll should pause instead, including once deadline expires: nodes
+                 are held before being touched, so pausing is always safe here
+        :rtype: bool
+        '''
+        deadline = deadline or self.deadline_for(rh.PHASE_ADMIT)
+        while True:
+            reasons = gate.check(self)
+            if not reasons:
+                return True
+            if self._should_pause(nodes):
+                return False
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= 0:
+                _LOG.warning('Pausing roll: cluster still lacks capacity after holding for the %s deadline: %s',
+                             deadline.name, '; '.join(reasons))
+                return False
+            _LOG.info('Holding roll until the cluster has capacity: %s', '; '.join(reasons))
+            time.sleep(gate.check_every if remaining is None else min(gate.check_every, remaining))
+
+    def wait_until_drained(self, name, check_every=5, deadline=None, stuck_checks=12):
+        '''
+        Loops around until node holds no shards, logging relocation progress.
+
+        :param name: Node name
+        :type name: str
+        :param deadline: Deadline for the wait. Defaults to the roll budget's for the drain phase.
+        :type deadline: Deadline
+        :param stuck_checks: Give up after this many checks in a row with the same shards left and none relocating
+        :type stuck_checks: int
+        :raises DeadlineExceeded: if deadline expires first
+        :raises Exception: if the drain stops making progress
+        :return: Success (always True)
+        :rtype: bool
+        '''
+        deadline = deadline or self.deadline_for(rh.PHASE_DRAIN)
+        _LOG.info('Waiting until node %s is drained', name)
+        last_shards, stuck = None, 0
+        while True:
+            # Only draining needs shard counts, so the watcher doesn't keep them
+            shards = self.shards_per_node().get(name, 0)
+            if self.watching:
+                health = self.watcher.view.health
+            else:
+                health = self.es.cluster.health(request_timeout=self.poll_timeout)
+            if not shards:
+                _LOG.info('Node %s is drained', name)
+                return True
+            relocating = health.get('relocating_shards')
+            _LOG.info('Draining node %s: %d shards left, %s relocating', name, shards,
+                      '?' if relocating is None else relocating)
+            if shards == last_shards and relocating == 0:
+                stuck += 1
+                if stuck >= stuck_checks:
+                    raise Exception(
+                        'Node %s cannot be drained: %d shards left and none relocating for %d checks. Check that '
+                        'the other nodes can take its shards (replicas vs data nodes, allocation awareness and '
+                        'filtering, disk watermarks).' % (name, shards, stuck))
+            else:
+                stuck = 0
+            last_shards = shards
+            deadline.sleep(check_every)
+
     def status(self):
         '''
         Get cluster health
@@ -109,22 +494,109 @@ class Cluster(object):
         :return: Cluster health
         :rtype: str
         '''
-        health = self.es.cluster.health()
+        health = self.es.cluster.health(request_timeout=self.poll_timeout)
         return health['status']
 
-    def wait_until_green(self, check_every=5):
+    def wait_until_green(self, check_every=5, deadline=None):
         '''
-        Loops around until cluster health is green
+        Loops around until cluster health is green.
+
+        Uses the cluster watcher's view if it's running, else long-poll health calls (wait_for_status) so the
+        cluster answers as soon as it turns green.
 
+        :param check_every: Seconds in between checks
+        :type check_every: int
+        :param deadline: Deadline for the wait. Defaults to the roll budget's for the green phase.
+        :type deadline: Deadline
+        :raises DeadlineExceeded: if deadline expires first
         :return: Success (always True)
         :rtype: bool
         '''
+        deadline = deadline or self.deadline_for(rh.PHASE_GREEN)
         _LOG.info('Waiting until cluster is green')
+        if self.watching:
+            return self._wait_for_view(lambda view: view.status == 'green', deadline)
+
         while True:
-            status = self.status()
-            if status == 'green':
+            # Leave the server-side wait some headroom under the request timeout
+            wait = max(1, self.long_poll_timeout - 5)
+            remaining = deadline.remaining()
+            if remaining is not None:
+                wait = max(1, min(wait, int(remaining)))
+            # ES < 7 answers a timed out wait with a 408 (and the health body)
+            health = self.es.cluster.health(wait_for_status='green', timeout='%ds' % wait,
+                                            request_timeout=self.long_poll_timeout, ignore=408)
+            if health.get('status') == 'green':
                 return True
-            time.sleep(check_every)
+            deadline.sleep(check_every)
+
+    def elected_master(self):
+        '''
+        Get the elected master's node id (_cat/master).
+
+        :return: Node id, or None if there is no elected master
+        :rtype: str
+        '''
+        raw = self.es.cat.master(h='id', request_timeout=self.poll_timeout)
+        return raw.strip() or None
+
+    def _master_and_node_count(self, view=None):
+        '''
+        :param view: Watcher view to read from, instead of asking the cluster
+        :type view: el_rollastico.watcher.ClusterView
+        :return: Elected master node id and node count, or (None, 0) if unknown
+        :rtype: tuple
+        '''
+        if view:
+            return view.master_node, view.health.get('number_of_nodes', 0)
+        try:
+            return self.elected_master(), self.es.cluster.health(request_timeout=self.poll_timeout)['number_of_nodes']
+        except Exception as e:
+            # No master, or the node we asked is the one restarting
+            _LOG.debug('Could not get elected master: %r', e)
+            return None, 0
+
+    def wait_until_stable_master(self, min_nodes, stable_checks=3, check_every=2, deadline=None):
+        '''
+        Loops around until the cluster has an elected master that stayed the same for stable_checks checks in a
+        row, with at least min_nodes nodes. Much quicker than waiting for green after rolling a dedicated master.
+
+        :param min_nodes: Minimum number of nodes in cluster
+        :type min_nodes: int
+        :param stable_checks: Consecutive checks the same master must be seen
+        :type stable_checks: int
+        :param check_every: Seconds in between checks
+        :type check_every: int
+        :param deadline: Deadline for the wait. Defaults to the roll budget's for the master phase.
+        :type deadline: Deadline
+        :raises DeadlineExceeded: if deadline expires first
+        :return: Elected master node id
+        :rtype: str
+        '''
+        deadline = deadline or self.deadline_for(rh.PHASE_MASTER)
+        _LOG.info('Waiting until cluster has a stable master and at least %d nodes', min_nodes)
+        last = None
+        streak = 0
+        seen = time.time()
+        while True:
+            view = None
+            if self.watching:
+                view = self.watcher.view
+                if view.refreshed_at <= seen:
+                    # Nothing new since the last check (or the watcher can't reach the cluster): nothing to count
+                    deadline.sleep(check_every)
+                    continue
+                seen = view.refreshed_at
+            master, node_count = self._master_and_node_count(view)
+            if master and node_count >= min_nodes:
+                streak = streak + 1 if master == last else 1
+                if streak >= stable_checks:
+                    _LOG.info('Cluster has a stable master=%s with %d nodes', master, node_count)
+                    return master
+            else:
+                streak = 0
+            last = master
+            deadline.sleep(check_every)
 
     def node_ips(self):
         '''
@@ -133,7 +605,7 @@ class Cluster(object):
         :return: List of node IPs
         :rtype: list
         '''
-        raw = self.es.cat.nodes(h='ip')
+        raw = self.es.cat.nodes(h='ip', request_timeout=self.poll_timeout)
         ret = []
         for line in raw.splitlines():
             line = line.rstrip('\n').strip()
@@ -151,10 +623,10 @@ class Cluster(object):
         '''
         return ip in self.node_ips()
 
-    def wait_until_node_joins(self, name, uptime_less_than=None, freshness_window=120, check_every=5):
+    def wait_until_node_joins(self, name, uptime_less_than=None, freshness_window=120, check_every=5, deadline=None):
         '''
         Loops around waiting until a node with the specified name joins the cluster with an uptime within
-        freshness_window.
+        freshness_window. Uses the cluster watcher's view if it's running.
 
         :param name: Node name
         :type name: str
@@ -162,32 +634,50 @@ class Cluster(object):
         :type uptime_less_than: int
         :param freshness_window: How recent (in secs) the join must be to pass
         :type freshness_window: int
+        :param deadline: Deadline for the wait. Defaults to the roll budget's for the join phase.
+        :type deadline: Deadline
+        :raises DeadlineExceeded: if deadline expires first
         :return: Node on Success
         :rtype: Node
         '''
+        deadline = deadline or self.deadline_for(rh.PHASE_JOIN)
         _LOG.info('Waiting until node %s joins with a freshness_window of %d secs and uptime_less_than=%d', name, freshness_window, uptime_less_than)
+        if self.watching:
+            return self._wait_for_view(
+                lambda view: self._find_fresh_node(view.nodes.values(), name, uptime_less_than, freshness_window),
+                deadline)
+
         while True:
-            for n in self.iter_nodes():
-                if n.name == name:
-                    if not n.uptime:
-                        _LOG.warn('Found node %s but it was lacking uptime?', n)
-                        continue
-                    uptime = n.uptime.total_seconds()
-                    if not uptime:
-                        _LOG.warn('Found node %s but uptime=%s?', n, uptime)
-                        continue
-                    if freshness_window and uptime > freshness_window:
-                        _LOG.debug('Found node %s but uptime=%s was under freshness_window=%ds',
-                                   name, uptime, freshness_window)
-                        continue
-                    if uptime_less_than and uptime > uptime_less_than:
-                        _LOG.debug('Found node %s but uptime=%s was above uptime_less_than=%s',
-                                   name, uptime, uptime_less_than)
-                        continue
-                    _LOG.info('Found node %s with uptime=%s was within freshness_window=%ds and uptime_less_than=%s',
-                              name, uptime, freshness_window, uptime_less_than)
-                    return n
-            time.sleep(check_every)
+            n = self._find_fresh_node(self.iter_nodes(), name, uptime_less_than, freshness_window)
+            if n:
+                return n
+            deadline.sleep(check_every)
+
+    def _find_fresh_node(self, nodes, name, uptime_less_than, freshness_window):
+        '''
+        :return: Node named name with an uptime within freshness_window and under uptime_less_than, if any
+        :rtype: Node
+        '''
+        for n in nodes:
+            if n.name == name:
+                if not n.uptime:
+                    _LOG.warn('Found node %s but it was lacking uptime?', n)
+                    continue
+                uptime = n.uptime.total_seconds()
+                if not uptime:
+                    _LOG.warn('Found node %s but uptime=%s?', n, uptime)
+                    continue
+                if freshness_window and uptime > freshness_window:
+                    _LOG.debug('Found node %s but uptime=%s was under freshness_window=%ds',
+                               name, uptime, freshness_window)
+                    continue
+                if uptime_less_than and uptime > uptime_less_than:
+                    _LOG.debug('Found node %s but uptime=%s was above uptime_less_than=%s',
+                               name, uptime, uptime_less_than)
+                    continue
+                _LOG.info('Found node %s with uptime=%s was within freshness_window=%ds and uptime_less_than=%s',
+                          name, uptime, freshness_window, uptime_less_than)
+                return n
 
     def iter_nodes(self):
         '''
@@ -198,9 +688,53 @@ class Cluster(object):
         '''
         return Node.iter_nodes(self)
 
+    @property
+    def watching(self):
+        '''
+        :return: If the cluster watcher is running
+        :rtype: bool
+        '''
+        return bool(self.watcher and self.watcher.running)
+
+    @contextmanager
+    def watch(self, subscriptions=None, interval=2):
+        '''
+        Run a cluster watcher for the duration of the context. Waits then use its cached view instead of
+        re-polling the cluster. If a watcher is already running it is reused.
+
+        :param subscriptions: Event name to callback (or list of callbacks), see el_rollastico.watcher
+        :type subscriptions: dict
+        :param interval: Seconds between refreshes
+        :type interval: int
+        :rtype: ClusterWatcher
+        '''
+        started = False
+        if not self.watching:
+            self.watcher = ClusterWatcher(self, interval=interval)
+            self.watcher.start()
+            started = True
+        watcher = self.watcher
+
+        subs = []
+        for event, callbacks in (subscriptions or {}).items():
+            if not isinstance(callbacks, (list, tuple)):
+                callbacks = [callbacks]
+            for cb in callbacks:
+                watcher.subscribe(event, cb)
+                subs.append((event, cb))
+        try:
+            yield watcher
+        finally:
+            for event, cb in subs:
+                watcher.unsubscribe(event, cb)
+            if started:
+                watcher.stop()
+
     def rolling_helper(self, callback, node_filter=lambda self, node: True,
-                       master=False, data=True,
-                       initial_wait_until_green=True, wait_until_green=True, disable_allocation=True):
+                       master=False, data=True, clients=False, client_batch_size=4,
+                       initial_wait_until_green=True, wait_until_green=True, disable_allocation=True,
+                       watch=True, subscriptions=None, drain=False, drain_ahead=False, drain_concurrency=None,
+                       budget=None, gate=None):
         '''
         Generic helper to perform rolling actions.
 
@@ -212,20 +746,150 @@ class Cluster(object):
         :type master: bool
         :param data: Include data nodes in this roll
         :type data: bool
+        :param clients: Include client (non master, non data) nodes in this roll. They are done last, concurrently in
+                        batches of client_batch_size, without allocation toggling or waiting for green.
+        :type clients: bool
+        :param client_batch_size: Client nodes to roll at once
+        :type client_batch_size: int
         :param initial_wait_until_green: Wait until cluster is green before rolling
         :type initial_wait_until_green: bool
         :param wait_until_green: Wait until cluster is green after each callback
         :type wait_until_green: bool
         :param disable_allocation: Disable allocation before callback, enable afterwards
         :type disable_allocation: bool
+        :param watch: Keep a cluster watcher running for the roll, so waits don't re-poll the cluster.
+        :type watch: bool
+        :param subscriptions: Event name to callback(s) to subscribe to the watcher for the roll. Callbacks can also
+                              subscribe themselves through self.watcher.
+        :type subscriptions: dict
+        :param drain: Instead of disabling allocation, exclude each data node from allocation and wait until its
+                      shards have relocated before the callback, then lift the exclusion. No shard goes
+                      under-replicated, at the cost of moving the node's data twice.
+        :type drain: bool
+        :param drain_ahead: While a drained node is being rolled, start draining the next one.
+        :type drain_ahead: bool
+        :param drain_concurrency: If set, bound concurrent recoveries per node and rebalances per cluster while
+                                  draining. Previous transient values are restored afterwards.
+        :type drain_concurrency: int
+        :param budget: Time budgets for the roll and its phases. A watchdog logs stall diagnostics for phases
+                       running too long either way.
+        :type budget: el_rollastico.deadline.RollBudget
+        :param gate: Before each node that holds shards, wait until this gate admits it (disk, queues, load), so
+                     its recovery doesn't compete with a saturated cluster.
+        :type gate: el_rollastico.gate.AdmissionGate
+        :return: Nodes left unrolled because the roll paused at the end of its budget (empty if it completed)
+        :rtype: list
         '''
         _LOG.info('Rolling through nodes on %s', self)
+        if client_batch_size < 1:
+            raise ValueError('client_batch_size must be at least 1, got %r' % client_batch_size)
+
+        self.budget = budget or RollBudget()
+        self.roll_deadline = Deadline(self.budget.roll, name='roll')
+        _LOG.info('Roll budget: %s', self.budget)
+        if gate:
+            _LOG.info('Admission gate: %s', gate)
+
+        args = (callback, node_filter, master, data, clients, client_batch_size, initial_wait_until_green,
+                wait_until_green, disable_allocation, drain, drain_ahead, gate)
+
+        # Transient settings the roll changes, restored afterwards
+        saved_keys = []
+        if drain:
+            saved_keys.append(SETTING_EXCLUDE_NAME)
+            if drain_concurrency:
+                saved_keys.extend([SETTING_NODE_CONCURRENT_RECOVERIES, SETTING_CLUSTER_CONCURRENT_REBALANCE])
+        if saved_keys:
+            saved_transient, saved_persistent = self.get_settings(saved_keys)
+        if drain:
+            # A transient exclusion overrides the persistent one, so whichever applies now must stay in
+            current = saved_transient.get(SETTING_EXCLUDE_NAME, saved_persistent.get(SETTING_EXCLUDE_NAME)) or ''
+            self._base_exclusions = [n.strip() for n in current.split(',') if n.strip()]
+            if self._base_exclusions:
+                _LOG.info('Keeping nodes excluded before the roll: %s', self._base_exclusions)
+            if drain_concurrency:
+                self.set_recovery_concurrency(drain_concurrency)
+        try:
+            with Watchdog(self, interval=self.budget.watchdog_interval, stall_after=self.budget.stall_after):
+                if watch:
+                    with self.watch(subscriptions=subscriptions):
+                        return self._rolling_helper(*args)
+                return self._rolling_helper(*args)
+        finally:
+            if saved_keys:
+                self._base_exclusions = []
+                self.restore_transient_settings(saved_keys, saved_transient, saved_persistent)
+
+    def request_stop(self):
+        '''
+        Make the roll pause at the next node boundary, once the node in progress is rolled and cleaned up after.
+        Safe to call from any thread.
+        '''
+        _LOG.warning('Stop requested, pausing %s at the next node boundary', self)
+        self._stop_requested.set()
 
-        nodes = list(self.iter_nodes())
+    def _should_pause(self, nodes):
+        '''
+        :param nodes: Nodes about to be rolled (concurrently)
+        :type nodes: list
+        :return: If the roll should pause rather than start rolling nodes: a stop was requested or the roll is out
+                 of budget
+        :rtype: bool
+        '''
+        if self._stop_requested.is_set():
+            _LOG.warning('Pausing roll on request before nodes %s', [n.name for n in nodes])
+            return True
+        return self._out_of_budget(nodes)
+
+    def _out_of_budget(self, nodes):
+        '''
+        :param nodes: Nodes about to be rolled (concurrently)
+        :type nodes: list
+        :return: If the roll should pause rather than start rolling nodes
+        :rtype: bool
+        '''
+        if not self.budget.pause:
+            return False
+        remaining = self.roll_deadline.remaining()
+        if remaining is None:
+            return False
+        estimate = 0
+        if self.history:
+            estimate = max([self.history.estimate(self.name, n.name, rh.PHASE_NODE) or 0 for n in nodes])
+        if remaining > estimate:
+            return False
+        _LOG.warning('Pausing roll: %ds left in budget, next nodes %s estimated to take %ds',
+                     max(0, remaining), [n.name for n in nodes], estimate)
+        return True
+
+    def _pause(self, unrolled):
+        self.progress.update(state='paused', node=None)
+        _LOG.warning('Roll paused at a node boundary. Nodes not rolled: %s', [n.name for n in unrolled])
+        return unrolled
+
+    def _next_drainable(self, roll_nodes, idx, node_filter):
+        '''
+        :return: Next data node after roll_nodes[idx] that will be rolled, if any
+        :rtype: Node
+        '''
+        for node in roll_nodes[idx + 1:]:
+            if node.is_data and node_filter(self, node):
+                return node
+
+    def _rolling_helper(self, callback, node_filter, master, data, clients, client_batch_size,
+                        initial_wait_until_green, wait_until_green, disable_allocation, drain, drain_ahead, gate):
+        if self.watching:
+            nodes = list(self.watcher.view.nodes.values())
+        else:
+            nodes = list(self.iter_nodes())
         master_nodes = [n for n in nodes if n.is_master]
         data_nodes = [n for n in nodes if n.is_data]
-        _LOG.info('Nodes: %d master, %d data', len(master_nodes), len(data_nodes))
-        _LOG.debug('nodes=%s', nodes)
+        client_nodes = [n for n in nodes if n.is_client]
+        _LOG.info('Nodes: %d master, %d data, %d client', len(master_nodes), len(data_nodes), len(client_nodes))
+
+        elected_master = self.elected_master()
+        _LOG.info('Elected master: %s', elected_master)
+        _LOG.debug('nodes=%s', Payload(nodes))
 
         if initial_wait_until_green:
             self.wait_until_green()
@@ -234,31 +898,126 @@ class Cluster(object):
         if master:
             roll_nodes.extend(master_nodes)
         if data:
-            roll_nodes.extend(data_nodes)
-        _LOG.debug('roll_nodes=%s', roll_nodes)
+            # Master eligible data nodes are already in when rolling masters
+            rolled = set(n.node_id for n in roll_nodes)
+            roll_nodes.extend(n for n in data_nodes if n.node_id not in rolled)
+        # Roll the elected master last (after data nodes too, if it holds data), so the roll causes a single election
+        roll_nodes.sort(key=lambda n: n.node_id == elected_master)
+        if not clients:
+            client_nodes = []
+        _LOG.debug('roll_nodes=%s client_nodes=%s', Payload(roll_nodes), Payload(client_nodes))
+        self.progress.update(state='rolling', total=len(roll_nodes) + len(client_nodes), done=0, node=None)
         
-        for node in roll_nodes:
+        for idx, node in enumerate(roll_nodes):
             _LOG.debug('Node: %s', node)
+            self.progress.update(done=idx, node=node.name)
             if node_filter(self, node):
                 _LOG.info('Node matched filter: %s', node)
 
+                # Dedicated masters hold no shards: no allocation toggling, and a stable master is enough
+                dedicated_master = node.is_master and not node.is_data
+
+                admitted = True
+                if gate and not dedicated_master:
+                    with self.phase(node, rh.PHASE_ADMIT):
+                        admitted = self.wait_for_admission(gate, [node])
+
+                if not admitted or self._should_pause([node]):
+                    return self._pause(
+                        [n for n in roll_nodes[idx:] + client_nodes if node_filter(self, n)])
+
+                eta = self.estimate_remaining(roll_nodes[idx:])
+                if eta is not None:
+                    _LOG.info('Estimated time remaining for %d nodes (at most): %s', len(roll_nodes) - idx, eta)
+
                 is_v2 = False
-                if LooseVersion(node.version) >= LooseVersion('2.0.0'):
+                if node.version_info >= LooseVersion('2.0.0'):
                     is_v2 = True
-                
-                if disable_allocation:
-                    self.disable_allocation(v2=is_v2)
 
-                # ready to run callback at this point
+                drain_node = drain and node.is_data
+
+                # Allocation is a persistent setting: put it back even if rolling the node fails or runs out of
+                # time. (The roll's exclusions are transient and restored by rolling_helper.)
+                allocation_disabled = False
+                with self.phase(node, rh.PHASE_NODE):
+                    if drain_node:
+                        next_node = drain_ahead and self._next_drainable(roll_nodes, idx, node_filter) or None
+                        # May have been drained ahead already; then this returns right away
+                        self.exclude_nodes([node.name])
+                        with self.phase(node, rh.PHASE_DRAIN):
+                            self.wait_until_drained(node.name)
+                        if next_node:
+                            self.exclude_nodes([node.name, next_node.name])
+                    elif disable_allocation and not dedicated_master:
+                        allocation_disabled = True
+                        self.disable_allocation(v2=is_v2)
+
+                    try:
+                        # ready to run callback at this point
+                        callback(self, node)
+
+                        if dedicated_master:
+                            with self.phase(node, rh.PHASE_MASTER):
+                                self.wait_until_stable_master(len(nodes))
+                            continue
+
+                        if drain_node:
+                            self.exclude_nodes(next_node and [next_node.name] or [])
+                        elif allocation_disabled:
+                            allocation_disabled = False
+                            self.enable_allocation(v2=is_v2)
+                        if wait_until_green:
+                            with self.phase(node, rh.PHASE_GREEN):
+                                self.wait_until_green(check_every=self.phase_poll_interval(node, rh.PHASE_GREEN, 5))
+                    finally:
+                        if allocation_disabled:
+                            _LOG.warning('Re-enabling allocation after failing to roll node %s', node)
+                            try:
+                                self.enable_allocation(v2=is_v2)
+                            except Exception:
+                                _LOG.exception('Could not re-enable allocation, it is still disabled on %s', self)
+
+        if client_nodes:
+            unrolled = self._roll_clients(callback, node_filter, client_nodes, client_batch_size, done=len(roll_nodes))
+            if unrolled:
+                return self._pause(unrolled)
+
+        self.progress.update(state='done', done=len(roll_nodes) + len(client_nodes), node=None)
+        return []
+
+    def _roll_clients(self, callback, node_filter, client_nodes, batch_size, done=0):
+        '''
+        Roll client nodes concurrently in batches. They hold no shards, so there is no allocation toggling and
+        no waiting for green; the callback's own rejoin checks are all that's needed.
+
+        :raises Exception: if the callback failed on any node of a batch (later batches are not started)
+        :return: Nodes left unrolled because the roll ran out of budget
+        :rtype: list
+        '''
+        matched = [n for n in client_nodes if node_filter(self, n)]
+        _LOG.info('Rolling %d of %d client nodes in batches of %d', len(matched), len(client_nodes), batch_size)
+
+        def roll_one(node):
+            _LOG.info('Client node matched filter: %s', node)
+            with self.phase(node, rh.PHASE_NODE):
                 callback(self, node)
 
-                if disable_allocation:
-                    self.enable_allocation(v2=is_v2)
-                if wait_until_green:
-                    self.wait_until_green()
+        for idx in range(0, len(matched), batch_size):
+            batch = matched[idx:idx + batch_size]
+            if self._should_pause(batch):
+                return matched[idx:]
+            self.progress.update(node=', '.join(n.name for n in batch))
+            results = run_concurrently(roll_one, batch, name='client')
+            failed = [node for node, ret, exc_info in results if exc_info]
+            if failed:
+                raise Exception('Failed to roll client nodes: %s' % ', '.join(n.name for n in failed))
+            done += len(batch)
+            self.progress.update(done=done)
+        return []
 
     def rolling_restart(self, master=False, data=True, initial_wait_until_green=True,
-                        heap_used_percent_threshold=85, highstate=False):
+                        heap_used_percent_threshold=85, highstate=False, clients=False, client_batch_size=4,
+                        drain=False, drain_ahead=False, drain_concurrency=None, budget=None, gate=None):
         '''
         Rolling restart.
 
@@ -272,6 +1031,22 @@ class Cluster(object):
         :type heap_used_percent_threshold: int
         :param highstate: Run a highstate prior to rolling the node.
         :type highstate: bool
+        :param clients: Include client (non master, non data) nodes in this roll, see rolling_helper
+        :type clients: bool
+        :param client_batch_size: Client nodes to roll at once
+        :type client_batch_size: int
+        :param drain: Drain data nodes by allocation exclusion before rolling them, see rolling_helper
+        :type drain: bool
+        :param drain_ahead: Drain the next data node while the current one is rolled
+        :type drain_ahead: bool
+        :param drain_concurrency: Bound concurrent recoveries while draining
+        :type drain_concurrency: int
+        :param budget: Time budgets for the roll and its phases, see rolling_helper
+        :type budget: el_rollastico.deadline.RollBudget
+        :param gate: Wait until this gate admits each node holding shards, see rolling_helper
+        :type gate: el_rollastico.gate.AdmissionGate
+        :return: Nodes left unrolled because the roll paused at the end of its budget
+        :rtype: list
         '''
         _LOG.info('Performing rolling restart %son %s', 'with highstate ' if highstate else '', self)
 
@@ -282,7 +1057,7 @@ class Cluster(object):
         def restart(self, node):
             _LOG.info('Found node with heap above threshold=%d: %s', heap_used_percent_threshold, node)
 
-            nso = NodeSaltOps(node)
+            nso = NodeSaltOps(node, saltcli=self.salt_pool)
 
             ''' Prep '''
 
@@ -291,12 +1066,14 @@ class Cluster(object):
             
             ''' Shutdown '''
                 
-            assert nso.ensure_elasticsearch_is_dead()
+            with self.phase(node, rh.PHASE_SHUTDOWN):
+                assert nso.ensure_elasticsearch_is_dead(**self.service_wait_opts(node, rh.PHASE_SHUTDOWN))
 
             ''' Highstate '''
             if highstate:
                 _LOG.info('Running a highstate on node=%s', node)
-                ret = nso.cmd('state.highstate', quiet=True)
+                with self.phase(node, rh.PHASE_HIGHSTATE):
+                    ret = nso.cmd('state.highstate', quiet=True)
 
                 # Check that the highstate succeeded on all items
                 # Note that when running state.highstate, the saltmaster is NOT the top level item in
@@ -309,24 +1086,34 @@ class Cluster(object):
 
             ''' Start '''
 
-            assert nso.service_start('elasticsearch')
-            time.sleep(15)
+            with self.phase(node, rh.PHASE_START):
+                assert nso.service_start('elasticsearch')
+                time.sleep(self.phase_poll_interval(node, rh.PHASE_START, 15))
                 
-            assert nso.wait_for_service_status('elasticsearch', True)
+                wait_opts = self.service_wait_opts(node, rh.PHASE_START)
+                started = nso.wait_for_service_status('elasticsearch', True, **wait_opts)
+                wait_opts['deadline'].check()
+                assert started
 
             ''' Wait until node joins '''
 
-            self.wait_until_node_joins(node.name, uptime_less_than=node.uptime.total_seconds())
+            with self.phase(node, rh.PHASE_JOIN):
+                self.wait_until_node_joins(node.name, uptime_less_than=node.uptime.total_seconds(),
+                                           check_every=self.phase_poll_interval(node, rh.PHASE_JOIN, 5))
 
         node_filter = lambda self, node: node.heap_used_percent > heap_used_percent_threshold
 
         return self.rolling_helper(
             restart, node_filter,
-            master=master, data=data,
+            master=master, data=data, clients=clients, client_batch_size=client_batch_size,
+            drain=drain, drain_ahead=drain_ahead, drain_concurrency=drain_concurrency, budget=budget,
+            gate=gate,
             initial_wait_until_green=initial_wait_until_green,
         )
 
-    def rolling_upgrade(self, minimum_version=None, master=False, data=True, initial_wait_until_green=True, hold_package=None):
+    def rolling_upgrade(self, minimum_version=None, master=False, data=True, initial_wait_until_green=True, hold_package=None,
+                        clients=False, client_batch_size=4, drain=False, drain_ahead=False, drain_concurrency=None,
+                        budget=None, gate=None):
 
         '''
         Rolling upgrade.
@@ -341,6 +1128,22 @@ class Cluster(object):
         :type initial_wait_until_green: bool
         :param hold_package: True or False will override the package hold mark. True will set 'hold' and False will set to 'unhold' post-upgrade. None will do nothing with the package mark, but will fail el_rollastico if the package is marked to be 'held'.
         :type hold_package: bool
+        :param clients: Include client (non master, non data) nodes in this roll, see rolling_helper
+        :type clients: bool
+        :param client_batch_size: Client nodes to roll at once
+        :type client_batch_size: int
+        :param drain: Drain data nodes by allocation exclusion before rolling them, see rolling_helper
+        :type drain: bool
+        :param drain_ahead: Drain the next data node while the current one is rolled
+        :type drain_ahead: bool
+        :param drain_concurrency: Bound concurrent recoveries while draining
+        :type drain_concurrency: int
+        :param budget: Time budgets for the roll and its phases, see rolling_helper
+        :type budget: el_rollastico.deadline.RollBudget
+        :param gate: Wait until this gate admits each node holding shards, see rolling_helper
+        :type gate: el_rollastico.gate.AdmissionGate
+        :return: Nodes left unrolled because the roll paused at the end of its budget
+        :rtype: list
         '''
         _LOG.info('Performing rolling upgrade on %s', self)
 
@@ -348,25 +1151,25 @@ class Cluster(object):
             raise Exception("Salt is required to perform a rolling upgrade.")
 
         def check_if_held(self, node):
-            nso = NodeSaltOps(node)
+            nso = NodeSaltOps(node, saltcli=self.salt_pool)
             return bool(nso.cmd('cmd.run', 'apt-mark showhold | grep -q elasticsearch'))
 
         def unhold_es_package(self, node):
-            nso = NodeSaltOps(node)
-            bool(nso.cmd('pkg.unhold', 'elasticsearch'))
+            nso = NodeSaltOps(node, saltcli=self.salt_pool)
+            return bool(nso.cmd('pkg.unhold', 'elasticsearch'))
 
         def hold_es_package(self, node):
-            nso = NodeSaltOps(node)
-            bool(nso.cmd('pkg.hold', 'elasticsearch'))
+            nso = NodeSaltOps(node, saltcli=self.salt_pool)
+            return bool(nso.cmd('pkg.hold', 'elasticsearch'))
 
         
         def node_filter(self, node):
             if not minimum_version:
                 return True
-            return LooseVersion(node.version) < LooseVersion(minimum_version)
+            return node.version_info < LooseVersion(minimum_version)
 
         def upgrade(self, node):
-            nso = NodeSaltOps(node)
+            nso = NodeSaltOps(node, saltcli=self.salt_pool)
             wait_for_rejoin = False
 
             ''' Prep '''
@@ -377,7 +1180,8 @@ class Cluster(object):
             ''' Highstate '''
 
             _LOG.info('Blazing it up (lighting a highstate) on node=%s', node)
-            ret = nso.cmd('state.highstate', quiet=True)
+            with self.phase(node, rh.PHASE_HIGHSTATE):
+                ret = nso.cmd('state.highstate', quiet=True)
 
             # Check for changes in the elasticsearch service from highstate run
             svc_changes = ret['service_|-elasticsearch_|-elasticsearch_|-running']['changes']
@@ -394,7 +1198,7 @@ class Cluster(object):
                 
                 ## Check if elasticsearch package is held on the node
                 _LOG.info("Checking if elasticsearch package is held on %s", node)
-                pkg_held = check_if_held(node)
+                pkg_held = check_if_held(self, node)
                 assert (not pkg_held) or (hold_package is not None)
                 if pkg_held:
                     if hold_package:
@@ -403,14 +1207,15 @@ class Cluster(object):
                     else:
                         _LOG.info('Package is held but ''--unhold'' was specified. '
                                   'Forcing permanent unhold of elasticsearch package.')
-                    assert unhold_es_package(node)
+                    assert unhold_es_package(self, node)
                 try:
                     _LOG.info('Working around broken pkg.latest in Salt')
 
                     # We force a stop here because elasticsearch upgrades can make
                     # service stop no longer work, leaving a zombie ES process that
                     # sysvinit cannot control
-                    assert nso.ensure_elasticsearch_is_dead()
+                    with self.phase(node, rh.PHASE_SHUTDOWN):
+                        assert nso.ensure_elasticsearch_is_dead(**self.service_wait_opts(node, rh.PHASE_SHUTDOWN))
                     wait_for_rejoin = True
 
                     ret = nso.cmd('pkg.install', ['elasticsearch'])
@@ -421,10 +1226,10 @@ class Cluster(object):
                     if hold_package is not None:
                         if hold_package:
                             _LOG.info('Setting hold mark on elasticsearch package.')
-                            hold_es_package(node)
+                            hold_es_package(self, node)
                         else:
                             _LOG.info('Removing hold mark from elasticsearch package.')
-                            unhold_es_package(node)
+                            unhold_es_package(self, node)
 
             ''' Wait for node to rejoin (if applicable) '''
 
@@ -432,13 +1237,21 @@ class Cluster(object):
                 _LOG.info('Waiting for node=%s to rejoin', node)
 
                 if not nso.service_status('elasticsearch'):
-                    assert nso.service_start('elasticsearch')
-                    time.sleep(15)
-                    assert nso.wait_for_service_status('elasticsearch', True)
-                self.wait_until_node_joins(node.name, uptime_less_than=node.uptime.total_seconds())
+                    with self.phase(node, rh.PHASE_START):
+                        assert nso.service_start('elasticsearch')
+                        time.sleep(self.phase_poll_interval(node, rh.PHASE_START, 15))
+                        wait_opts = self.service_wait_opts(node, rh.PHASE_START)
+                        started = nso.wait_for_service_status('elasticsearch', True, **wait_opts)
+                        wait_opts['deadline'].check()
+                        assert started
+                with self.phase(node, rh.PHASE_JOIN):
+                    self.wait_until_node_joins(node.name, uptime_less_than=node.uptime.total_seconds(),
+                                               check_every=self.phase_poll_interval(node, rh.PHASE_JOIN, 5))
 
         return self.rolling_helper(
             upgrade, node_filter,
-            master=master, data=data,
+            master=master, data=data, clients=clients, client_batch_size=client_batch_size,
+            drain=drain, drain_ahead=drain_ahead, drain_concurrency=drain_concurrency, budget=budget,
+            gate=gate,
             initial_wait_until_green=initial_wait_until_green,
         )
@@ -1,14 +1,36 @@
+import os
+
+# Level of el_rollastico's own loggers. DEBUG logs (capped) Salt returns and node lists.
+LOG_LEVEL = os.environ.get('ROLLASTIC_LOG_LEVEL', 'INFO')
+# Console log format: standard or json (one object per line)
+LOG_FORMAT = os.environ.get('ROLLASTIC_LOG_FORMAT', 'standard')
+# Maximum characters of a Salt or ES payload in a log record
+LOG_PAYLOAD_LIMIT = int(os.environ.get('ROLLASTIC_LOG_PAYLOAD_LIMIT', 2048))
+# Only emit one in this many DEBUG records from each logging call (eg in poll loops)
+LOG_DEBUG_SAMPLE = int(os.environ.get('ROLLASTIC_LOG_DEBUG_SAMPLE', 1))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
     'formatters': {
         'standard': {
             'format': '%(asctime)s| %(name)s/%(processName)s[%(process)d]-%(threadName)s: %(message)s @%(funcName)s:%(lineno)d #%(levelname)s',
-        }
+        },
+        'json': {
+            '()': 'el_rollastico.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        'sample': {
+            '()': 'el_rollastico.log.SampleFilter',
+            'every': LOG_DEBUG_SAMPLE,
+            'level': 'DEBUG',
+        },
     },
     'handlers': {
         'console': {
-            'formatter': 'standard',
+            'formatter': LOG_FORMAT,
+            'filters': ['sample'],
             'class': 'logging.StreamHandler',
         },
         # 'logfile': {
@@ -22,11 +44,11 @@ LOGGING = {
         'level': 'INFO',
     },
     'loggers': {
-        'el_rollastico': dict(level='DEBUG'),
+        'el_rollastico': dict(level=LOG_LEVEL),
 
         # These are super noisy
         'elasticsearch': dict(level='WARNING'),
         'requests': dict(level='WARNING'),
         'urllib3': dict(level='WARNING'),
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,198 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+from el_rollastico import history as rh
+
+import threading
+import time
+
+# Phase deadlines applied unless the budget gives its own: holding at the admission gate never ends by itself, so
+# the roll pauses after this long
+DEFAULT_PHASE_TIMEOUTS = {rh.PHASE_ADMIT: 3600}
+
+
+class DeadlineExceeded(Exception):
+    '''
+    Raised when a wait runs past its deadline.
+    '''
+
+
+class Deadline(object):
+    '''
+    A point in time a wait must finish by, optionally bounded by a parent deadline (eg phase within a roll).
+
+    A deadline without a budget (and without a parent) never expires.
+    '''
+
+    def __init__(self, budget=None, parent=None, name=None):
+        '''
+        Init
+
+        :param budget: Seconds from now. None for no limit of its own.
+        :type budget: float
+        :param parent: Deadline that also bounds this one
+        :type parent: Deadline
+        :param name: Name used in messages
+        :type name: str
+        '''
+        self.name = name
+        self.parent = parent
+        self.budget = budget
+        self.expires_at = None
+        if budget is not None:
+            self.expires_at = time.time() + budget
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.name} remaining={1}>'.format(self, self.remaining())
+
+    def remaining(self):
+        '''
+        :return: Seconds left (may be negative), or None if unlimited
+        :rtype: float
+        '''
+        ret = None
+        if self.expires_at is not None:
+            ret = self.expires_at - time.time()
+        if self.parent:
+            parent = self.parent.remaining()
+            if parent is not None and (ret is None or parent < ret):
+                ret = parent
+        return ret
+
+    @property
+    def expired(self):
+        '''
+        :rtype: bool
+        '''
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self):
+        '''
+        :raises DeadlineExceeded: if expired
+        '''
+        if self.expired:
+            raise DeadlineExceeded('Deadline exceeded: %s (budget=%ss)' % (self.name, self.budget))
+
+    def sleep(self, seconds):
+        '''
+        Sleep for seconds, but no further than the deadline.
+
+        :raises DeadlineExceeded: if expired once done sleeping
+        '''
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = max(0, min(seconds, remaining))
+        time.sleep(seconds)
+        self.check()
+
+
+class RollBudget(object):
+    '''
+    Time budgets for a roll.
+    '''
+
+    def __init__(self, roll=None, phases=None, pause=True, stall_after=600, watchdog_interval=60):
+        '''
+        Init
+
+        :param roll: Seconds for the whole roll (the maintenance window). None for no limit.
+        :type roll: float
+        :param phases: Seconds per phase name (see el_rollastico.history), bounding each wait of that phase, on top
+                       of DEFAULT_PHASE_TIMEOUTS
+        :type phases: dict
+        :param pause: When the roll budget runs out, stop at the next node boundary (before starting a node that
+                      would not fit, based on history) instead of failing the wait in progress.
+        :type pause: bool
+        :param stall_after: Seconds a phase may run (more if history says it usually takes longer) before the
+                            watchdog logs stall diagnostics
+        :type stall_after: float
+        :param watchdog_interval: Seconds between watchdog checks
+        :type watchdog_interval: float
+        '''
+        self.roll = roll
+        self.phases = dict(DEFAULT_PHASE_TIMEOUTS, **(phases or {}))
+        self.pause = pause
+        self.stall_after = stall_after
+        self.watchdog_interval = watchdog_interval
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} roll={0.roll} phases={0.phases} pause={0.pause}>'.format(self)
+
+
+class Watchdog(object):
+    '''
+    Background thread logging stall diagnostics when a roll phase runs for too long.
+    '''
+
+    def __init__(self, cluster, interval=60, stall_after=600):
+        '''
+        Init
+
+        :param cluster: Cluster instance
+        :type cluster: Cluster
+        :param interval: Seconds between checks
+        :type interval: float
+        :param stall_after: Seconds a phase may run before it's considered stalled. History for that node and phase
+                            may only make it longer: short phases (eg a quick join, or a gate that usually admits
+                            right away) would otherwise look stalled within seconds.
+        :type stall_after: float
+        '''
+        self.cluster = cluster
+        self.interval = interval
+        self.stall_after = stall_after
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.cluster} stall_after={0.stall_after}>'.format(self)
+
+    def check(self):
+        '''
+        Log stalled phases and diagnostics for them.
+
+        :return: Stalled (node, phase, elapsed) tuples
+        :rtype: list
+        '''
+        stalled = []
+        now = time.time()
+        for node, phase, started in self.cluster.active_phases():
+            elapsed = now - started
+            threshold = self.cluster.phase_timeout(node, phase, self.stall_after, minimum=self.stall_after)
+            if elapsed > threshold:
+                stalled.append((node, phase, elapsed))
+                _LOG.warning('Phase %s on node=%s has been running for %ds (stall threshold %ds)',
+                             phase, node.name, elapsed, threshold)
+        if stalled:
+            try:
+                _LOG.warning('Stall diagnostics:\n%s', self.cluster.stall_diagnostics())
+            except Exception as e:
+                _LOG.warning('Could not collect stall diagnostics: %r', e)
+        return stalled
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                _LOG.exception('Watchdog check failed')
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='watchdog-%s' % self.cluster.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
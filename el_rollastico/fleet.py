@@ -0,0 +1,246 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+from el_rollastico.cluster import Cluster
+from el_rollastico.util import run_concurrently
+
+import threading
+import time
+
+try:
+    import yaml
+except ImportError:
+    pass
+import sys
+HAS_YAML = 'yaml' in sys.modules
+
+# Inventory keys passed on to Cluster() rather than to the roll
+CLUSTER_OPTS = ('timeout', 'sniff', 'maxsize', 'poll_timeout', 'long_poll_timeout')
+
+
+class Target(object):
+    '''
+    A cluster to roll as part of a fleet.
+    '''
+
+    def __init__(self, name, master_node, cluster_opts=None, opts=None):
+        '''
+        Init
+
+        :param name: Name used in reports
+        :type name: str
+        :param master_node: Initial node(s) to connect to, see Cluster
+        :type master_node: str
+        :param cluster_opts: Extra kwargs for Cluster()
+        :type cluster_opts: dict
+        :param opts: Roll options for this cluster (overriding the command's)
+        :type opts: dict
+        '''
+        self.name = name
+        self.master_node = master_node
+        self.cluster_opts = cluster_opts or {}
+        self.opts = opts or {}
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.name} master_node={0.master_node}>'.format(self)
+
+
+def load_inventory(path, roll_opts=None):
+    '''
+    Load fleet targets from a YAML inventory::
+
+        defaults:
+          masters: true
+        clusters:
+          logs:
+            master_node: es-logs-01
+            kill_at_heap: 75
+          metrics:
+            master_node: es-metrics-01,es-metrics-02
+            maxsize: 50
+
+    Keys other than master_node are roll options named like the command line options (with underscores), or
+    client options (see CLUSTER_OPTS). ``clusters`` may also be a list of mappings with a ``name`` key.
+
+    :param path: Inventory file path
+    :type path: str
+    :param roll_opts: Names of the roll options clusters may set. None to accept any.
+    :type roll_opts: iterable
+    :raises ImportError: if PyYAML is not installed
+    :raises ValueError: on an invalid inventory (malformed YAML, unknown option, missing master_node, duplicate name)
+    :return: Targets
+    :rtype: list
+    '''
+    if not HAS_YAML:
+        raise ImportError("PyYAML is required to read an inventory: pip install 'el_rollastico[inventory]'")
+
+    with open(path) as f:
+        try:
+            inv = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ValueError('Inventory %s is not valid YAML: %s' % (path, e))
+    if not isinstance(inv, dict):
+        raise ValueError('Inventory %s must be a mapping with clusters (and defaults)' % path)
+
+    defaults = inv.get('defaults') or {}
+    clusters = inv.get('clusters') or {}
+    if isinstance(clusters, dict):
+        clusters = [dict(entry or {}, name=name) for name, entry in sorted(clusters.items())]
+
+    targets = []
+    for entry in clusters:
+        entry = dict(defaults, **entry)
+        name = entry.pop('name', None)
+        master_node = entry.pop('master_node', None)
+        if not master_node:
+            raise ValueError('Inventory %s: cluster %s has no master_node' % (path, name))
+        name = name or master_node
+        if name in [t.name for t in targets]:
+            raise ValueError('Inventory %s: cluster %s is listed more than once' % (path, name))
+        cluster_opts = dict((k, entry.pop(k)) for k in CLUSTER_OPTS if k in entry)
+        if roll_opts is not None:
+            unknown = sorted(set(entry) - set(roll_opts))
+            if unknown:
+                raise ValueError('Inventory %s: cluster %s has unknown options %s (expected any of %s)' % (
+                    path, name, ', '.join(unknown), ', '.join(sorted(set(roll_opts) | set(CLUSTER_OPTS)))))
+        targets.append(Target(name, master_node, cluster_opts=cluster_opts, opts=entry))
+    return targets
+
+
+class Fleet(object):
+    '''
+    Rolls several clusters concurrently, each with its own Cluster, sharing a Salt client pool and history.
+    '''
+
+    def __init__(self, targets, history=None, salt_pool=None, max_parallel=None, report_every=60):
+        '''
+        Init
+
+        :param targets: Clusters to roll
+        :type targets: list of Target
+        :param history: Roll history shared by all clusters
+        :type history: el_rollastico.history.RollHistory
+        :param salt_pool: Salt client pool shared by all clusters
+        :type salt_pool: el_rollastico.node.SaltClientPool
+        :param max_parallel: Maximum clusters rolling at once. None for all.
+        :type max_parallel: int
+        :param report_every: Seconds between combined progress reports
+        :type report_every: int
+        '''
+        self.targets = targets
+        self.history = history
+        self.salt_pool = salt_pool
+        self.max_parallel = max_parallel
+        self.report_every = report_every
+        self.clusters = {}
+        self.states = dict((t.name, 'pending') for t in targets)
+        self.errors = {}
+        self._stopping = threading.Event()
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {1}>'.format(self, [t.name for t in self.targets])
+
+    def report(self):
+        '''
+        Combined progress report, one line per cluster.
+
+        :rtype: str
+        '''
+        lines = []
+        for t in self.targets:
+            state = self.states[t.name]
+            cluster = self.clusters.get(t.name)
+            line = '%s: %s' % (t.name, state)
+            if cluster and cluster.progress['total']:
+                line += ' %(done)d/%(total)d nodes' % cluster.progress
+                if state == 'rolling' and cluster.progress['node']:
+                    line += ' (at %s)' % cluster.progress['node']
+            if t.name in self.errors:
+                line += ' error=%r' % (self.errors[t.name],)
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def stop(self):
+        '''
+        Pause every cluster at its next node boundary and don't start the ones still pending. Safe to call from any
+        thread.
+        '''
+        self._stopping.set()
+        for cluster in list(self.clusters.values()):
+            cluster.request_stop()
+
+    def _roll_one(self, target, roll, opts):
+        if self._stopping.is_set():
+            _LOG.warning('Not rolling %s: fleet is stopping', target.name)
+            return
+        self.states[target.name] = 'connecting'
+        cluster = Cluster(target.master_node, history=self.history, salt_pool=self.salt_pool, **target.cluster_opts)
+        self.clusters[target.name] = cluster
+        if self._stopping.is_set():
+            cluster.request_stop()
+        _LOG.info('Cluster %s status: %s', target.name, cluster.status())
+
+        self.states[target.name] = 'rolling'
+        kwargs = dict(opts, **target.opts)
+        try:
+            roll(cluster, **kwargs)
+        except Exception as e:
+            self.states[target.name] = 'failed'
+            self.errors[target.name] = e
+            raise
+        self.states[target.name] = cluster.progress['state'] == 'paused' and 'paused' or 'done'
+
+    @property
+    def paused(self):
+        '''
+        :return: Names of clusters that paused at the end of their roll budget, with nodes left to roll
+        :rtype: list
+        '''
+        return sorted(name for name, state in self.states.items() if state == 'paused')
+
+    def _reporter(self, stop):
+        while not stop.wait(self.report_every):
+            _LOG.info('Fleet progress:\n%s', self.report())
+
+    def run(self, roll, **opts):
+        '''
+        Roll all targets.
+
+        :param roll: Called as roll(cluster, **opts) per cluster, with opts overridden by the target's
+        :type roll: function
+        :raises KeyboardInterrupt: once the clusters have paused and cleaned up after an interrupt (see stop)
+        :return: True if every cluster rolled successfully
+        :rtype: bool
+        '''
+        _LOG.info('Rolling %d clusters (max_parallel=%s): %s', len(self.targets), self.max_parallel,
+                  ', '.join(t.name for t in self.targets))
+
+        def roll_one(target):
+            try:
+                return self._roll_one(target, roll, opts)
+            except Exception as e:
+                if target.name not in self.errors:
+                    self.states[target.name] = 'failed'
+                    self.errors[target.name] = e
+                raise
+
+        stop = threading.Event()
+        reporter = None
+        if len(self.targets) > 1 and self.report_every:
+            reporter = threading.Thread(target=self._reporter, args=(stop,), name='fleet-report')
+            reporter.daemon = True
+            reporter.start()
+
+        started = time.time()
+        try:
+            run_concurrently(roll_one, self.targets, max_workers=self.max_parallel, name='cluster',
+                             on_interrupt=self.stop)
+        except KeyboardInterrupt:
+            _LOG.warning('Fleet roll interrupted after %ds:\n%s', time.time() - started, self.report())
+            raise
+        finally:
+            stop.set()
+
+        _LOG.info('Fleet roll finished in %ds:\n%s', time.time() - started, self.report())
+        return not self.errors
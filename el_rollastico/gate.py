@@ -0,0 +1,126 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+# Thread pools whose queues and rejections reflect search and indexing pressure. Indexing is "bulk" before ES 6.3
+# and "write" from then on; whichever the node reports is used.
+SEARCH_POOLS = ('search',)
+INDEX_POOLS = ('bulk', 'write')
+
+
+def _load_average(os_stats):
+    '''
+    1 minute load average from node os stats, across ES versions.
+
+    :param os_stats: os section of a node's stats
+    :type os_stats: dict
+    :return: Load average or None if not reported (eg Windows)
+    :rtype: float
+    '''
+    # 5.x+
+    load = os_stats.get('cpu', {}).get('load_average')
+    if isinstance(load, dict):
+        return load.get('1m')
+    # 1.x reports [1m, 5m, 15m], 2.x a single value
+    load = os_stats.get('load_average')
+    if isinstance(load, list):
+        return load and load[0] or None
+    return load
+
+
+class AdmissionGate(object):
+    '''
+    Decides whether the cluster has the capacity to recover the shards of another node right now.
+
+    Holds the roll while any node is over the disk usage threshold (from _cat/allocation), has too many queued
+    search or indexing requests, rejected any since the previous check, or is over the load threshold.
+
+    Rejections are counted from the previous check, so use one gate per cluster.
+    '''
+
+    def __init__(self, disk_percent=85, queue=50, rejections=0, load=None, check_every=10):
+        '''
+        Init
+
+        :param disk_percent: Maximum disk used percentage on any node. ES' default low watermark is 85%, over which
+                             no shards are allocated to a node. None to ignore.
+        :type disk_percent: int
+        :param queue: Maximum queued search or indexing requests (per pool) on any node. None to ignore.
+        :type queue: int
+        :param rejections: Maximum search or indexing rejections on any node between two checks. None to ignore.
+        :type rejections: int
+        :param load: Maximum 1 minute load average on any node. None to ignore.
+        :type load: float
+        :param check_every: Seconds in between checks while holding
+        :type check_every: int
+        '''
+        self.disk_percent = disk_percent
+        self.queue = queue
+        self.rejections = rejections
+        self.load = load
+        self.check_every = check_every
+        self._rejected = {}
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} disk_percent={0.disk_percent} queue={0.queue} ' \
+               'rejections={0.rejections} load={0.load}>'.format(self)
+
+    @property
+    def needs_stats(self):
+        '''
+        :return: If node stats are needed, ie any threshold other than disk is set
+        :rtype: bool
+        '''
+        return self.queue is not None or self.rejections is not None or self.load is not None
+
+    def check(self, cluster):
+        '''
+        Check the cluster against thresholds.
+
+        :param cluster: Cluster instance
+        :type cluster: Cluster
+        :return: Reasons to hold, empty if the next node may be rolled
+        :rtype: list
+        '''
+        reasons = []
+        if self.disk_percent is not None:
+            for name, pct in sorted(cluster.disk_percent_per_node().items()):
+                if pct > self.disk_percent:
+                    reasons.append('node %s disk at %d%% (max %d%%)' % (name, pct, self.disk_percent))
+
+        if self.needs_stats:
+            stats = cluster.es.nodes.stats(metric='thread_pool,os', request_timeout=cluster.poll_timeout)
+            for node_id, node_stats in sorted(stats['nodes'].items()):
+                reasons.extend(self._check_node(node_id, node_stats))
+        return reasons
+
+    def _check_node(self, node_id, node_stats):
+        reasons = []
+        name = node_stats.get('name', node_id)
+        thread_pool = node_stats.get('thread_pool', {})
+
+        for kind, pools in (('search', SEARCH_POOLS), ('indexing', INDEX_POOLS)):
+            for pool in pools:
+                if pool not in thread_pool:
+                    continue
+                stats = thread_pool[pool]
+
+                if self.queue is not None and stats.get('queue', 0) > self.queue:
+                    reasons.append('node %s has %d queued %s requests (max %d)' % (
+                        name, stats['queue'], kind, self.queue))
+
+                key = (node_id, pool)
+                rejected = stats.get('rejected', 0)
+                previous = self._rejected.get(key)
+                self._rejected[key] = rejected
+                # Counters reset when the node restarts
+                if self.rejections is not None and previous is not None and rejected >= previous and \
+                        rejected - previous > self.rejections:
+                    reasons.append('node %s rejected %d %s requests since last check (max %d)' % (
+                        name, rejected - previous, kind, self.rejections))
+
+        if self.load is not None:
+            load = _load_average(node_stats.get('os', {}))
+            if load is not None and load > self.load:
+                reasons.append('node %s load average at %.2f (max %.2f)' % (name, load, self.load))
+        return reasons
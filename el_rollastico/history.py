@@ -0,0 +1,256 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.el_rollastico', 'history.db')
+
+# Phases recorded per node during a roll
+PHASE_NODE = 'node'
+PHASE_SHUTDOWN = 'shutdown'
+PHASE_HIGHSTATE = 'highstate'
+PHASE_START = 'start'
+PHASE_JOIN = 'join'
+PHASE_GREEN = 'green'
+PHASE_MASTER = 'master'
+PHASE_DRAIN = 'drain'
+PHASE_ADMIT = 'admit'
+PHASES = (PHASE_NODE, PHASE_SHUTDOWN, PHASE_HIGHSTATE, PHASE_START, PHASE_JOIN, PHASE_GREEN, PHASE_MASTER,
+          PHASE_DRAIN, PHASE_ADMIT)
+# Phases whose waits are bounded by a per phase deadline (see Cluster.deadline_for)
+TIMED_PHASES = (PHASE_SHUTDOWN, PHASE_START, PHASE_JOIN, PHASE_GREEN, PHASE_MASTER, PHASE_DRAIN, PHASE_ADMIT)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS phase_durations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cluster TEXT NOT NULL,
+    node TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phase_durations_lookup ON phase_durations (cluster, phase, node, recorded_at);
+'''
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile.
+
+    :param values: Values
+    :type values: list
+    :param pct: Percentile, 0-100
+    :type pct: float
+    :return: Value at percentile or None if there are no values
+    :rtype: float
+    '''
+    if not values:
+        return
+    values = sorted(values)
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[max(0, min(idx, len(values) - 1))]
+
+
+class RollHistory(object):
+    '''
+    Local SQLite store of per-node, per-phase durations from past rolls.
+
+    Used to derive adaptive timeouts and poll intervals, ETAs and anomaly warnings.
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, samples=20, min_samples=3, margin=2.0, anomaly_factor=3.0):
+        '''
+        Init
+
+        :param path: Path to SQLite database. Parent directory is created if missing.
+        :type path: str
+        :param samples: Number of most recent samples to consider per lookup
+        :type samples: int
+        :param min_samples: Minimum samples needed before history overrides defaults
+        :type min_samples: int
+        :param margin: Multiplier applied to p95 to derive a timeout
+        :type margin: float
+        :param anomaly_factor: A phase taking longer than p95 * anomaly_factor is reported as anomalous
+        :type anomaly_factor: float
+        '''
+        self.path = path
+        self.samples = samples
+        self.min_samples = min_samples
+        self.margin = margin
+        self.anomaly_factor = anomaly_factor
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            parent = os.path.dirname(path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+        # In-memory databases only live as long as their connection, so keep one around.
+        self._memory_conn = path == ':memory:' and self._connect() or None
+
+        with self._lock:
+            conn = self._conn()
+            try:
+                conn.executescript(_SCHEMA)
+                conn.commit()
+            finally:
+                self._release(conn)
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.path}>'.format(self)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+
+    def _conn(self):
+        # A connection per operation keeps this safe to share across threads.
+        return self._memory_conn or self._connect()
+
+    def _release(self, conn):
+        if conn is not self._memory_conn:
+            conn.close()
+
+    def record(self, cluster, node, phase, duration):
+        '''
+        Record a phase duration.
+
+        :param cluster: Cluster name
+        :type cluster: str
+        :param node: Node name
+        :type node: str
+        :param phase: Phase name
+        :type phase: str
+        :param duration: Duration in seconds
+        :type duration: float
+        '''
+        with self._lock:
+            conn = self._conn()
+            try:
+                conn.execute(
+                    'INSERT INTO phase_durations (cluster, node, phase, duration, recorded_at) VALUES (?, ?, ?, ?, ?)',
+                    (cluster, node, phase, float(duration), time.time()))
+                conn.commit()
+            finally:
+                self._release(conn)
+
+    def durations(self, cluster, phase, node=None):
+        '''
+        Most recent durations for a phase.
+
+        :param cluster: Cluster name
+        :type cluster: str
+        :param phase: Phase name
+        :type phase: str
+        :param node: Node name. If None, durations for all nodes in cluster are returned.
+        :type node: str
+        :return: Durations in seconds, most recent first
+        :rtype: list
+        '''
+        sql = 'SELECT duration FROM phase_durations WHERE cluster = ? AND phase = ?'
+        args = [cluster, phase]
+        if node:
+            sql += ' AND node = ?'
+            args.append(node)
+        sql += ' ORDER BY recorded_at DESC LIMIT ?'
+        args.append(self.samples)
+
+        with self._lock:
+            conn = self._conn()
+            try:
+                return [row[0] for row in conn.execute(sql, args)]
+            finally:
+                self._release(conn)
+
+    def _samples(self, cluster, node, phase):
+        '''
+        Node's own history if there is enough of it, else the cluster-wide history for the phase.
+        '''
+        values = self.durations(cluster, phase, node=node)
+        if len(values) >= self.min_samples:
+            return values
+        values = self.durations(cluster, phase)
+        if len(values) >= self.min_samples:
+            return values
+        return []
+
+    def estimate(self, cluster, node, phase):
+        '''
+        Estimated (median) duration of a phase.
+
+        :return: Seconds, or None if there is not enough history
+        :rtype: float
+        '''
+        return percentile(self._samples(cluster, node, phase), 50)
+
+    def timeout(self, cluster, node, phase, default, minimum=None):
+        '''
+        Adaptive timeout for a phase: p95 * margin.
+
+        :param default: Returned if there is not enough history
+        :type default: float
+        :param minimum: Never return a timeout lower than this
+        :type minimum: float
+        :return: Timeout in seconds
+        :rtype: float
+        '''
+        p95 = percentile(self._samples(cluster, node, phase), 95)
+        if p95 is None:
+            return default
+        ret = p95 * self.margin
+        if minimum is not None:
+            ret = max(ret, minimum)
+        return ret
+
+    def poll_interval(self, cluster, node, phase, default, minimum=1, divisor=10):
+        '''
+        Adaptive poll interval for a phase: median / divisor, capped to default.
+
+        :param default: Returned if there is not enough history; also the upper bound
+        :type default: float
+        :return: Interval in seconds
+        :rtype: float
+        '''
+        median = percentile(self._samples(cluster, node, phase), 50)
+        if median is None:
+            return default
+        return max(minimum, min(default, median / float(divisor)))
+
+    def is_anomalous(self, cluster, node, phase, duration):
+        '''
+        Check if duration is much slower than the node's own history.
+
+        :return: p95 of the node's history if anomalous, else None
+        :rtype: float
+        '''
+        values = self.durations(cluster, phase, node=node)
+        if len(values) < self.min_samples:
+            return
+        p95 = percentile(values, 95)
+        if p95 and duration > p95 * self.anomaly_factor:
+            return p95
+
+    @contextmanager
+    def phase(self, cluster, node, phase):
+        '''
+        Context manager timing a phase. Records the duration on success and warns if it was anomalous.
+
+        :param cluster: Cluster name
+        :type cluster: str
+        :param node: Node name
+        :type node: str
+        :param phase: Phase name
+        :type phase: str
+        '''
+        started = time.time()
+        yield
+        duration = time.time() - started
+
+        p95 = self.is_anomalous(cluster, node, phase, duration)
+        if p95:
+            _LOG.warning('Phase %s on node=%s took %.1fs, much slower than its history (p95=%.1fs)',
+                         phase, node, duration, p95)
+        self.record(cluster, node, phase, duration)
@@ -1,20 +1,184 @@
 import logging
 import logging.config
 import inspect
+import copy
+import json
+import threading
 
 from el_rollastico import config
 
 _CONFIGURED = False
 
+try:
+    _TEXT_TYPES = (str, unicode)
+except NameError:
+    _TEXT_TYPES = (str,)
 
-def _configure():
+# Attributes every LogRecord has; anything else was passed through extra= and is a structured field
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | frozenset(['message', 'asctime'])
+
+
+def configure(level=None, fmt=None):
+    '''
+    (Re)configure logging from config.LOGGING.
+
+    :param level: Level for el_rollastico loggers, overriding config.LOG_LEVEL
+    :type level: str
+    :param fmt: Console format (standard or json), overriding config.LOG_FORMAT
+    :type fmt: str
+    '''
     global _CONFIGURED
+
+    conf = copy.deepcopy(config.LOGGING)
+    if _CONFIGURED:
+        # Loggers created since the first configuration (eg __main__'s, Salt's) must keep working
+        conf['disable_existing_loggers'] = False
+    if level:
+        conf['loggers']['el_rollastico']['level'] = level.upper()
+    if fmt:
+        conf['handlers']['console']['formatter'] = fmt
+    logging.config.dictConfig(conf)
+
+    _CONFIGURED = True
+
+
+def _configure():
     if _CONFIGURED:
         return
+    configure()
 
-    logging.config.dictConfig(config.LOGGING)
 
-    _CONFIGURED = True
+def _chunks(obj, limit):
+    '''
+    Serialize obj JSON-ish, piece by piece, so the caller can stop as soon as it has enough.
+    '''
+    if isinstance(obj, dict):
+        yield '{'
+        for idx, (k, v) in enumerate(obj.items()):
+            if idx:
+                yield ', '
+            for chunk in _chunks(k, limit):
+                yield chunk
+            yield ': '
+            for chunk in _chunks(v, limit):
+                yield chunk
+        yield '}'
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        yield '['
+        for idx, v in enumerate(obj):
+            if idx:
+                yield ', '
+            for chunk in _chunks(v, limit):
+                yield chunk
+        yield ']'
+    elif isinstance(obj, _TEXT_TYPES):
+        yield json.dumps(obj[:limit + 1])
+    elif obj is None or isinstance(obj, (bool, int, float)):
+        yield json.dumps(obj)
+    else:
+        yield repr(obj)[:limit + 1]
+
+
+def bounded_dumps(obj, limit=None):
+    '''
+    Serialize obj for a log record, doing no more work than needed for the first limit characters.
+
+    :param obj: Object, usually a Salt return or ES response
+    :param limit: Maximum characters, defaults to config.LOG_PAYLOAD_LIMIT
+    :type limit: int
+    :rtype: str
+    '''
+    if limit is None:
+        limit = config.LOG_PAYLOAD_LIMIT
+    out = []
+    size = 0
+    for chunk in _chunks(obj, limit):
+        out.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return '%s...<truncated at %d chars>' % (''.join(out)[:limit], limit)
+    return ''.join(out)
+
+
+class Payload(object):
+    '''
+    Log argument serialized (and truncated) only if the record is actually emitted::
+
+        _LOG.debug('salt: %s=%s', fun, Payload(ret))
+    '''
+
+    __slots__ = ('obj', 'limit')
+
+    def __init__(self, obj, limit=None):
+        '''
+        Init
+
+        :param obj: Object to log
+        :param limit: Maximum characters, defaults to config.LOG_PAYLOAD_LIMIT
+        :type limit: int
+        '''
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self):
+        return bounded_dumps(self.obj, self.limit)
+
+    __repr__ = __str__
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Lets through one in every records at or below level from each logging call; records above level always pass.
+    Filtered records are never formatted, so their Payloads are never serialized.
+    '''
+
+    def __init__(self, every=1, level='DEBUG'):
+        '''
+        Init
+
+        :param every: Emit one in this many records per logging call
+        :type every: int
+        :param level: Sample records at or below this level
+        :type level: str
+        '''
+        logging.Filter.__init__(self)
+        self.every = every
+        self.level = logging.getLevelName(level) if isinstance(level, _TEXT_TYPES) else level
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.every <= 1 or record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per record, with fields passed through extra= kept as top level keys.
+    '''
+
+    def format(self, record):
+        ret = dict(
+            time=self.formatTime(record),
+            level=record.levelname,
+            logger=record.name,
+            process=record.process,
+            thread=record.threadName,
+            func=record.funcName,
+            line=record.lineno,
+            message=record.getMessage(),
+        )
+        for k, v in vars(record).items():
+            if k not in _RECORD_ATTRS:
+                ret[k] = v
+        if record.exc_info:
+            ret['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(ret, default=str)
 
 
 def _namespace_from_calling_context():
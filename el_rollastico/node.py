@@ -1,13 +1,21 @@
-from el_rollastico.log import get_logger
+from el_rollastico.log import get_logger, Payload
 
 _LOG = get_logger()
 
+from el_rollastico import profiling
+from contextlib import contextmanager
 from distutils.version import LooseVersion
 from datetime import timedelta
+import threading
 import time
 import re
 import sys
 
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
 try:
     import salt.client
 except ImportError:
@@ -15,122 +23,276 @@ except ImportError:
 HAS_SALT = 'salt.client' in sys.modules
 
 
-class Node(dict):
+def _parse_roles(info):
+    '''
+    Node roles from a nodes info entry. Uses "roles" (5.x+), falling back to node settings with ES defaults.
+
+    :rtype: tuple
+    '''
+    if 'roles' in info:
+        return tuple(info['roles'])
+
+    node_settings = info.get('settings', {}).get('node', {})
+    if node_settings.get('client') == 'true':
+        return ()
+    roles = []
+    if node_settings.get('master', 'true') == 'true':
+        roles.append('master')
+    if node_settings.get('data', 'true') == 'true':
+        roles.append('data')
+    return tuple(roles)
+
+
+def _parse_publish_host(http_addr, version_info):
+    '''
+    :return: Node published host address (just the address), or None if it can't be parsed
+    :rtype: str
+    '''
+    if not http_addr:
+        return
+
+    if version_info <= LooseVersion('2.0.0'):
+        m = re.match(r'^inet\[(?P<publish_host>[^/]*)/(?P<publish_ip>[^\]]+)]$', http_addr)
+        if not m:
+            # Some 1.x builds report a plain host:port
+            if re.match(r'^[^\s/\[\]]+:\d+$', http_addr):
+                return http_addr
+            _LOG.warning('Could not parse http_address: %s', http_addr)
+            return
+        for v in m.groups():
+            if v:
+                return v
+    else:
+        # 2.x just returns the hostname, no BS
+        return http_addr
+
+
+def _parse_jvm(stats):
+    '''
+    :param stats: Node's entry from nodes stats (jvm metric)
+    :type stats: dict
+    :return: Node fields from stats: heap_used_percent, heap_max_in_bytes and uptime
+    :rtype: dict
+    '''
+    jvm = stats.get('jvm', {})
+    mem = jvm.get('mem', {})
+    uptime = None
+    if jvm.get('uptime_in_millis'):
+        uptime = timedelta(seconds=jvm['uptime_in_millis'] / 1000)
+    return dict(heap_used_percent=mem.get('heap_used_percent'), heap_max_in_bytes=mem.get('heap_max_in_bytes'),
+                uptime=uptime)
+
+
+class Node(object):
     '''
-    Represents a cluster node.
+    Immutable snapshot of a cluster node, holding only the parsed fields rolls use.
     '''
 
-    def __init__(self, cluster, node_id=None):
+    __slots__ = ('node_id', 'name', 'version', 'version_info', 'roles', 'heap_used_percent', 'heap_max_in_bytes',
+                 'uptime', 'host', 'ip', 'http_address')
+
+    def __init__(self, node_id, name=None, version=None, roles=(), heap_used_percent=None, heap_max_in_bytes=None,
+                 uptime=None, host=None, ip=None, http_address=None):
         '''
         Init
 
-        :param cluster: Cluster instance
-        :type cluster: Cluster
         :param node_id: Node unique identifier
         :type node_id: str
+        :param name: Node name
+        :type name: str
+        :param version: ES version
+        :type version: str
+        :param roles: Node roles (master, data, ingest, ...)
+        :type roles: tuple
+        :param heap_used_percent: JVM heap used percentage
+        :type heap_used_percent: int
+        :param heap_max_in_bytes: JVM max heap
+        :type heap_max_in_bytes: int
+        :param uptime: JVM uptime
+        :type uptime: timedelta
+        :param host: Node host
+        :type host: str
+        :param ip: Node IP
+        :type ip: str
+        :param http_address: HTTP address as reported by ES
+        :type http_address: str
+        '''
+        version_info = LooseVersion(version or '0')
+        fields = dict(
+            node_id=node_id, name=name, version=version, version_info=version_info, roles=tuple(roles),
+            heap_used_percent=heap_used_percent, heap_max_in_bytes=heap_max_in_bytes, uptime=uptime,
+            host=host, ip=ip, http_address=http_address,
+        )
+        for k, v in fields.items():
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    @classmethod
+    def from_es(cls, node_id, info, stats):
         '''
-        self.cluster = cluster
-        self.node_id = node_id
-        if self.node_id:
-            self.populate()
+        Parse a node from its nodes info and nodes stats entries.
+
+        :param node_id: Node unique identifier
+        :type node_id: str
+        :param info: Node's entry from nodes info (settings and http metrics)
+        :type info: dict
+        :param stats: Node's entry from nodes stats (jvm metric)
+        :type stats: dict
+        :rtype: Node
+        '''
+        if not info:
+            _LOG.warning('Bad result for node info. node_id=%s info=%s', node_id, info)
+        if not stats:
+            _LOG.warning('Bad result for node stats. node_id=%s stats=%s', node_id, stats)
+
+        return cls(
+            node_id,
+            name=info.get('name') or stats.get('name'),
+            version=info.get('version'),
+            roles=_parse_roles(info),
+            host=info.get('host'),
+            ip=info.get('ip'),
+            # 5.x+ dropped the top-level http_address
+            http_address=info.get('http_address') or info.get('http', {}).get('publish_address'),
+            **_parse_jvm(stats)
+        )
+
+    def with_stats(self, stats):
+        '''
+        :param stats: Node's entry from nodes stats (jvm metric)
+        :type stats: dict
+        :return: Copy of this snapshot with heap and uptime from stats
+        :rtype: Node
+        '''
+        fields = dict((k, getattr(self, k)) for k in self.__slots__ if k not in ('node_id', 'version_info'))
+        fields.update(_parse_jvm(stats))
+        return self.__class__(self.node_id, **fields)
 
     @classmethod
-    def iter_nodes(cls, cluster):
+    def iter_nodes(cls, cluster, node_ids=None):
         '''
-        Iterates through all nodes.
+        Iterates through nodes, using one nodes info and one nodes stats call for all of them.
 
         :param cluster: Cluster instance
         :type cluster: Cluster
-        :return: Generator for all nodes
+        :param node_ids: Only these nodes. None for the whole cluster.
+        :type node_ids: list
+        :return: Generator for the nodes
         :rtype: generator
         '''
-        info = cluster.es.nodes.info(metric='settings')
-        for node_id, node in info['nodes'].items():
-            yield cls(cluster, node_id)
+        node_id = node_ids and ','.join(sorted(node_ids)) or None
+        info = cluster.es.nodes.info(node_id=node_id, metric='settings,http',
+                                     request_timeout=cluster.poll_timeout)['nodes']
+        stats = cluster.es.nodes.stats(node_id=node_id, metric='jvm', request_timeout=cluster.poll_timeout)['nodes']
+        for node_id, node_info in info.items():
+            yield cls.from_es(node_id, node_info, stats.get(node_id, {}))
 
-    def populate(self):
+    def as_dict(self):
         '''
-        Clears self and populates information from cluster.
+        :return: Dict view of this snapshot
+        :rtype: dict
         '''
-        self.clear()
-
-        info = self.cluster.es.nodes.info(self.node_id)['nodes'].get(self.node_id, {})
-        if not info:
-            _LOG.warning('Bad result for node info. node_id=%s info=%s', self.node_id, info)
-        self.update(info)
+        ret = dict((k, getattr(self, k)) for k in self.__slots__)
+        ret['version_info'] = str(self.version_info)
+        ret['publish_host'] = self.publish_host
+        return ret
 
-        stats = self.cluster.es.nodes.stats(self.node_id)['nodes'].get(self.node_id, {})
-        if not stats:
-            _LOG.warning('Bad result for node stats. node_id=%s stats=%s', self.node_id, stats)
-        self.update(stats)
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.name} master={0.is_master} data={0.is_data} client={0.is_client}>'.format(self)
 
     @property
-    def name(self):
-        '''
-        :rtype: str
+    def publish_host(self):
         '''
-        return self.get('name')
+        Parsed on access: only needed for master nodes, and one odd address shouldn't fail a whole nodes listing.
 
-    @property
-    def version(self):
-        '''
+        :return: Published host address, or None if it can't be parsed
         :rtype: str
         '''
-        return self['version']
-
-    def __repr__(self):
-        return '<{0.__class__.__name__} {0.name} master={0.is_master} data={0.is_data}>'.format(self)
+        return _parse_publish_host(self.http_address, self.version_info)
 
     @property
     def is_master(self):
         '''
         :rtype: bool
         '''
-        return self['settings']['node']['master'] == 'true'
+        return 'master' in self.roles
 
     @property
     def is_data(self):
         '''
         :rtype: bool
         '''
-        return self['settings']['node']['data'] == 'true'
+        return any(r == 'data' or r.startswith('data_') for r in self.roles)
 
     @property
-    def heap_used_percent(self):
+    def is_client(self):
         '''
-        :rtype: int
+        :return: If node is neither master eligible nor data (client/coordinating/ingest only)
+        :rtype: bool
         '''
-        return self['jvm']['mem']['heap_used_percent']
+        return not self.is_master and not self.is_data
 
-    @property
-    def uptime(self):
+
+class SaltClientPool(object):
+    '''
+    Pool of Salt LocalClients, shared between threads (eg several clusters rolling at once).
+
+    Quacks like a LocalClient for cmd() so it can be handed to NodeSaltOps as saltcli.
+    '''
+
+    def __init__(self, size=4):
         '''
-        :rtype: int
+        Init
+
+        :param size: Maximum number of LocalClients
+        :type size: int
         '''
-        ms = self['jvm'].get('uptime_in_millis')
-        if not ms:
-            return
-        seconds = self['jvm']['uptime_in_millis'] / 1000
-        return timedelta(seconds=seconds)
+        assert HAS_SALT
 
-    @property
-    def publish_host(self):
+        self.size = size
+        self._idle = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} size={0.size} created={0._created}>'.format(self)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                with profiling.timed('salt', 'LocalClient()'):
+                    return salt.client.LocalClient()
+        return self._idle.get()
+
+    @contextmanager
+    def client(self):
         '''
-        :return: Node published host address (just the address)
-        :rtype: str
+        Check out a LocalClient for the duration of the context.
+
+        :rtype: salt.client.LocalClient
         '''
-        http_addr = self['http_address']
-        
-        if LooseVersion(self.version) <= LooseVersion('2.0.0'):
-            m = re.match(r'^inet\[(?P<publish_host>[^/]*)/(?P<publish_ip>[^\]]+)]$', http_addr)
-            if not m:
-                raise Exception('Could not match http_address: %s' % http_addr)
-            for v in m.groups():
-                if v:
-                    return v
-        else:
-            # 2.x just returns the hostname, no BS
-            return http_addr
+        cli = self._checkout()
+        try:
+            yield cli
+        finally:
+            self._idle.put(cli)
+
+    def cmd(self, *args, **kwargs):
+        '''
+        LocalClient.cmd on a pooled client.
+        '''
+        with self.client() as cli:
+            return cli.cmd(*args, **kwargs)
 
 
 class NodeSaltOps(object):
@@ -144,14 +306,15 @@ class NodeSaltOps(object):
 
         :param node: Node instance
         :type node: Node
-        :param saltcli: Salt client instance
-        :type saltcli: salt.client.LocalClient
+        :param saltcli: Salt client instance or pool
+        :type saltcli: salt.client.LocalClient or SaltClientPool
         '''
         assert HAS_SALT
 
         self.node = node
         if not saltcli:
-            saltcli = salt.client.LocalClient()
+            with profiling.timed('salt', 'LocalClient()'):
+                saltcli = salt.client.LocalClient()
         self.s = saltcli
 
     def cmd(self, fun, arg=(), kwarg=None, quiet=False):
@@ -164,16 +327,19 @@ class NodeSaltOps(object):
         :type arg: list
         :param kwarg: Kwargs for function
         :type kwarg: dict
-        :param quiet: If True, does not log return value to debug level
+        :param quiet: If True, does not log return value to debug level (else it is logged lazily, capped to
+                      config.LOG_PAYLOAD_LIMIT)
         :type quiet: bool
         :return: Results
         '''
-        ret = self.s.cmd(self.node.name, fun, arg=arg, kwarg=kwarg)
+        with profiling.timed('salt', fun):
+            ret = self.s.cmd(self.node.name, fun, arg=arg, kwarg=kwarg)
         assert len(ret) == 1
         assert self.node.name in ret
         ret = ret.get(self.node.name, {})
         if not quiet:
-            _LOG.debug('salt: %s(%s %s)=%s', fun, arg, kwarg, ret)
+            _LOG.debug('salt: %s(%s %s)=%s', fun, arg, kwarg, Payload(ret),
+                       extra=dict(salt_fun=fun, minion=self.node.name))
         return ret
 
     def ping(self):
@@ -207,7 +373,7 @@ class NodeSaltOps(object):
         _LOG.info('Stopping service=%s', name)
         return bool(self.cmd('service.stop', [name]))
 
-    def wait_for_service_status(self, name, status, check_every=10, timeout_iterations=6):
+    def wait_for_service_status(self, name, status, check_every=10, timeout_iterations=6, deadline=None):
         '''
         Waits for service status with specified timeout.
 
@@ -219,7 +385,9 @@ class NodeSaltOps(object):
         :type check_every: int
         :param timeout_iterations: Iterations of check_every secs before timing out
         :type timeout_iterations: int
-        :return: True on success, False on timeout
+        :param deadline: Deadline bounding the wait, on top of timeout_iterations
+        :type deadline: el_rollastico.deadline.Deadline
+        :return: True on success, False on timeout (including deadline expiry, which callers check themselves)
         :rtype: bool
         '''
         _LOG.info('Waiting for service=%s status to be %s on node=%s', name, status, self.node)
@@ -233,16 +401,30 @@ class NodeSaltOps(object):
             if timeout_iterations and x == timeout_iterations:
                 return False
 
-            time.sleep(check_every)
+            remaining = deadline and deadline.remaining()
+            if remaining is not None and remaining <= 0:
+                _LOG.warn('Deadline %s expired waiting for service=%s status on node=%s', deadline.name, name,
+                          self.node)
+                return False
+            time.sleep(check_every if remaining is None else min(check_every, remaining))
             x += 1
 
-    def ensure_elasticsearch_is_dead(self, kill_on_shutdown_timeout=True):
+    def ensure_elasticsearch_is_dead(self, kill_on_shutdown_timeout=True, check_every=10, timeout_iterations=6,
+                                     deadline=None):
         '''
         Stops Elasticsearch service and ensures it's dead. If kill_on_shutdown_timeout, if process does not die within
-        120s then run a naive killall java on the box and wait until it's shown as dead.
+        check_every * timeout_iterations secs then run a naive killall java on the box and wait until it's shown as dead.
 
         :param kill_on_shutdown_timeout: If we should attempt a killall java on the box if a shutdown does not work.
         :type kill_on_shutdown_timeout: bool
+        :param check_every: Seconds in between checks
+        :type check_every: int
+        :param timeout_iterations: Iterations of check_every secs before timing out
+        :type timeout_iterations: int
+        :param deadline: Deadline bounding the wait for the service to stop. Once it expires, java still gets killed
+                         (if kill_on_shutdown_timeout) and waited for as above.
+        :type deadline: el_rollastico.deadline.Deadline
+        :raises el_rollastico.deadline.DeadlineExceeded: if deadline expired, once ES is dead
         :raises Exception: if we could not ensure ES is dead
         :return: True on success
         :rtype: bool
@@ -250,8 +432,9 @@ class NodeSaltOps(object):
         _LOG.info('Ensuring elasticsearch is dead on node=%s', self.node)
         self.service_stop('elasticsearch')
 
-        # This will wait for up to one minute
-        dead = self.wait_for_service_status('elasticsearch', False)
+        # This will wait for up to one minute by default
+        dead = self.wait_for_service_status('elasticsearch', False, check_every=check_every,
+                                            timeout_iterations=timeout_iterations, deadline=deadline)
         if not dead:
             _LOG.warn('Timeout waiting for service=elasticsearch to die on node=%s', self.node)
 
@@ -261,8 +444,12 @@ class NodeSaltOps(object):
                 self.cmd('cmd.run', ['killall java'])
                 time.sleep(15)
 
-            # This will wait for up to another minute
-            dead = self.wait_for_service_status('elasticsearch', False)
+            # This will wait for up to another minute by default. Not bound by deadline, which has likely expired
+            # already: the kill must get its chance to work.
+            dead = self.wait_for_service_status('elasticsearch', False, check_every=check_every,
+                                                timeout_iterations=timeout_iterations)
             if not dead:
                 raise Exception("Could not stop service=elasticsearch on node=%s" % self.node)
+            if deadline:
+                deadline.check()
         return dead
@@ -0,0 +1,238 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+PROFILER_CPROFILE = 'cprofile'
+PROFILER_SAMPLE = 'sample'
+PROFILERS = (PROFILER_CPROFILE, PROFILER_SAMPLE)
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# ES and Salt call stats: (kind, call, caller) -> [count, total secs, max secs]. None when not profiling.
+_CALLS = None
+_CALLS_LOCK = threading.Lock()
+
+# Frames from these modules are never reported as a call's caller
+_SKIP_MODULES = (__name__, 'contextlib')
+
+
+def _frame_label(code):
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name),
+                         code.co_firstlineno)
+
+
+def _caller():
+    '''
+    Label of the el_rollastico function that made the call being timed, skipping the timed call site itself.
+    '''
+    frame = sys._getframe(1)
+    while frame and frame.f_globals.get('__name__') in _SKIP_MODULES:
+        frame = frame.f_back
+    # The instrumented call site (eg the transport or NodeSaltOps.cmd)
+    frame = frame and frame.f_back
+    while frame:
+        module = frame.f_globals.get('__name__') or ''
+        if module.startswith('el_rollastico') and module not in _SKIP_MODULES:
+            return '%s.%s' % (module.rsplit('.', 1)[-1], getattr(frame.f_code, 'co_qualname', frame.f_code.co_name))
+        frame = frame.f_back
+    return '?'
+
+
+@contextmanager
+def timed(kind, call):
+    '''
+    Time an ES or Salt call for the call stats report. Does nothing unless profiling.
+
+    :param kind: Kind of call, eg es or salt
+    :type kind: str
+    :param call: Call name, eg an ES request path or Salt function
+    :type call: str
+    '''
+    if _CALLS is None:
+        yield
+        return
+
+    key = (kind, call, _caller())
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        with _CALLS_LOCK:
+            stats = _CALLS.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+
+def call_stats_report():
+    '''
+    :return: ES and Salt call counts and timings per call and calling function, by total time
+    :rtype: str
+    '''
+    with _CALLS_LOCK:
+        calls = sorted((_CALLS or {}).items(), key=lambda item: -item[1][1])
+    lines = ['%-5s %7s %9s %8s %8s  %s' % ('kind', 'calls', 'total(s)', 'mean(s)', 'max(s)', 'call <- caller')]
+    for (kind, call, caller), (count, total, longest) in calls:
+        lines.append('%-5s %7d %9.3f %8.3f %8.3f  %s <- %s' % (
+            kind, count, total, total / count, longest, call, caller))
+    return '\n'.join(lines)
+
+
+class Profiler(object):
+    '''
+    Profiles a command: cProfile (deterministic, every thread) or a sampling profiler (low overhead, every thread),
+    plus ES and Salt call stats.
+    '''
+
+    def __init__(self, mode=PROFILER_CPROFILE, output=None, interval=SAMPLE_INTERVAL, top=40):
+        '''
+        Init
+
+        :param mode: One of PROFILERS
+        :type mode: str
+        :param output: Path to write the report to, with the raw profile next to it (.pstats for cProfile, .folded
+                       stacks for flame graphs when sampling). None to log the report.
+        :type output: str
+        :param interval: Seconds between samples when sampling
+        :type interval: float
+        :param top: Functions to list in the report
+        :type top: int
+        '''
+        if mode not in PROFILERS:
+            raise Exception('Unknown profiler: %s' % mode)
+        self.mode = mode
+        self.output = output
+        self.interval = interval
+        self.top = top
+        self._profile = None
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._samples = Counter()
+        self._sampler = None
+        self._stop = threading.Event()
+        self._started = None
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} mode={0.mode} output={0.output}>'.format(self)
+
+    def _thread_hook(self, frame, event, arg):
+        # Installed through threading.setprofile: runs once in each new thread and hands it its own cProfile
+        sys.setprofile(None)
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Python 3.12+ only allows one profiler, which then covers every thread already
+            return
+        with self._lock:
+            self._thread_profiles.append(prof)
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                self._samples[tuple(stack)] += 1
+
+    def start(self):
+        global _CALLS
+        with _CALLS_LOCK:
+            _CALLS = {}
+        self._started = time.time()
+        _LOG.info('Profiling with %s', self.mode)
+
+        if self.mode == PROFILER_CPROFILE:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            threading.setprofile(self._thread_hook)
+        else:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, name='profile-sampler')
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def stop(self):
+        '''
+        Stop profiling and write (or log) the report.
+        '''
+        global _CALLS
+        elapsed = time.time() - self._started
+        if self.mode == PROFILER_CPROFILE:
+            threading.setprofile(None)
+            self._profile.disable()
+            report = self._cprofile_report()
+        else:
+            self._stop.set()
+            self._sampler.join()
+            report = self._sample_report()
+
+        report = 'Profiled %.1fs with %s\n\n%s\n\nES and Salt calls:\n%s\n' % (
+            elapsed, self.mode, report, call_stats_report())
+        with _CALLS_LOCK:
+            _CALLS = None
+
+        if not self.output:
+            _LOG.info('Profile report:\n%s', report)
+            return
+        with open(self.output, 'w') as f:
+            f.write(report)
+        _LOG.info('Profile report written to %s', self.output)
+
+    def _cprofile_report(self):
+        buf = StringIO()
+        stats = pstats.Stats(self._profile, stream=buf)
+        with self._lock:
+            for prof in self._thread_profiles:
+                try:
+                    stats.add(prof)
+                except TypeError:
+                    # Thread never got to run any profiled code
+                    pass
+        if self.output:
+            stats.dump_stats(self.output + '.pstats')
+        stats.sort_stats('cumulative').print_stats(self.top)
+        return buf.getvalue().strip()
+
+    def _sample_report(self):
+        total = sum(self._samples.values())
+        inclusive = Counter()
+        own = Counter()
+        for stack, count in self._samples.items():
+            own[stack[-1]] += count
+            for code in set(stack):
+                inclusive[code] += count
+
+        lines = ['%d samples every %ss across all threads' % (total, self.interval)]
+        for title, counter in (('Inclusive (function on the stack)', inclusive), ('Self (function running)', own)):
+            lines.append('')
+            lines.append(title + ':')
+            for code, count in counter.most_common(self.top):
+                lines.append('%7d %5.1f%%  %s' % (count, 100.0 * count / (total or 1), _frame_label(code)))
+
+        if self.output:
+            with open(self.output + '.folded', 'w') as f:
+                for stack, count in self._samples.items():
+                    f.write('%s %d\n' % (';'.join(_frame_label(code) for code in stack), count))
+        return '\n'.join(lines)
@@ -0,0 +1,98 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+import sys
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+# Seconds between checks on worker threads. Waits without a timeout can't be interrupted on Python 2.
+JOIN_INTERVAL = 0.5
+
+
+def run_concurrently(func, items, max_workers=None, name='worker', on_interrupt=None):
+    '''
+    Calls func(item) for each item using up to max_workers threads. A single item is called in the calling thread,
+    so KeyboardInterrupt unwinds func (and runs its cleanup) directly.
+
+    An exception in one call does not stop the others.
+
+    :param func: Function to call per item
+    :type func: function
+    :param items: Items
+    :type items: list
+    :param max_workers: Maximum concurrent calls. None means one thread per item.
+    :type max_workers: int
+    :param name: Thread name prefix
+    :type name: str
+    :param on_interrupt: Called on the first KeyboardInterrupt while waiting for the threads, to make the calls
+                         wind down; they are then waited for before KeyboardInterrupt is raised again. A second
+                         KeyboardInterrupt, or any KeyboardInterrupt without on_interrupt, is raised right away.
+    :type on_interrupt: function
+    :return: List of (item, result, exc_info) in the order of items. exc_info is None on success.
+    :rtype: list
+    '''
+    items = list(items)
+    if not items:
+        return []
+    if not max_workers or max_workers > len(items):
+        max_workers = len(items)
+
+    results = [None] * len(items)
+    queue = Queue()
+    for idx, item in enumerate(items):
+        queue.put((idx, item))
+
+    def worker():
+        while True:
+            try:
+                idx, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[idx] = (item, func(item), None)
+            except Exception:
+                _LOG.exception('Failed on %s', item)
+                results[idx] = (item, None, sys.exc_info())
+
+    if len(items) == 1:
+        worker()
+        return results
+
+    # Threads signal when they're done, rather than being join()ed: an interrupted join can leave a thread that's
+    # still running reported as stopped
+    done = [threading.Event() for _ in range(max_workers)]
+
+    def run_worker(idx):
+        try:
+            worker()
+        finally:
+            done[idx].set()
+
+    for i in range(max_workers):
+        t = threading.Thread(target=run_worker, args=(i,), name='%s-%d' % (name, i))
+        t.daemon = True
+        t.start()
+
+    interrupted = False
+    while True:
+        alive = [d for d in done if not d.is_set()]
+        if not alive:
+            break
+        try:
+            alive[0].wait(JOIN_INTERVAL)
+        except KeyboardInterrupt:
+            if interrupted or not on_interrupt:
+                raise
+            interrupted = True
+            _LOG.warning('Interrupted, waiting for %d %s threads to stop and clean up. Interrupt again to exit now.',
+                         len(alive), name)
+            on_interrupt()
+    if interrupted:
+        raise KeyboardInterrupt()
+    return results
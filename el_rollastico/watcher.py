@@ -0,0 +1,271 @@
+from el_rollastico.log import get_logger
+
+_LOG = get_logger()
+
+from el_rollastico.node import Node
+
+import threading
+import time
+
+EVENT_NODE_JOINED = 'node-joined'
+EVENT_NODE_LEFT = 'node-left'
+EVENT_HEALTH_CHANGED = 'health-changed'
+EVENT_MASTER_CHANGED = 'master-changed'
+EVENTS = (EVENT_NODE_JOINED, EVENT_NODE_LEFT, EVENT_HEALTH_CHANGED, EVENT_MASTER_CHANGED)
+
+
+class ClusterView(object):
+    '''
+    Cached view of a cluster: nodes and health.
+    '''
+
+    __slots__ = ('version', 'master_node', 'nodes', 'stats_at', 'health', 'refreshed_at')
+
+    def __init__(self, version=None, master_node=None, nodes=None, stats_at=None, health=None):
+        '''
+        Init
+
+        :param version: Cluster state version
+        :type version: int
+        :param master_node: Elected master node id
+        :type master_node: str
+        :param nodes: Nodes by node id
+        :type nodes: dict
+        :param stats_at: When each node's jvm stats (heap, uptime) were read, by node id
+        :type stats_at: dict
+        :param health: Cluster health
+        :type health: dict
+        '''
+        self.version = version
+        self.master_node = master_node
+        self.nodes = nodes or {}
+        self.stats_at = stats_at or {}
+        self.health = health or {}
+        self.refreshed_at = time.time()
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} version={0.version} status={1} nodes={2}>'.format(
+            self, self.status, len(self.nodes))
+
+    @property
+    def status(self):
+        '''
+        :return: Cluster health status
+        :rtype: str
+        '''
+        return self.health.get('status')
+
+    def node_by_name(self, name):
+        '''
+        :rtype: Node
+        '''
+        for node in self.nodes.values():
+            if node.name == name:
+                return node
+
+
+class ClusterWatcher(object):
+    '''
+    Background thread keeping a single cached ClusterView up to date and publishing change events.
+
+    Health and the cluster state's node list are polled every interval. Nodes are only read when they join, and
+    their jvm stats (heap, uptime) re-read when missing or older than stats_max_age, so a steady cluster costs two
+    small calls per interval however busy its shards are.
+
+    Subscribers are called from the watcher thread as callback(event, data, view), where data is the Node for
+    node events, the elected master node id for master-changed and (old_status, new_status) for health-changed.
+    '''
+
+    def __init__(self, cluster, interval=2, stats_max_age=60):
+        '''
+        Init
+
+        :param cluster: Cluster instance
+        :type cluster: Cluster
+        :param interval: Seconds between refreshes
+        :type interval: int
+        :param stats_max_age: Seconds after which a node's jvm stats are re-read
+        :type stats_max_age: int
+        '''
+        self.cluster = cluster
+        self.interval = interval
+        self.stats_max_age = stats_max_age
+        self.view = ClusterView()
+        self._subscribers = dict((e, []) for e in EVENTS)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return '<{0.__class__.__name__} {0.cluster} {0.view}>'.format(self)
+
+    @property
+    def running(self):
+        '''
+        :rtype: bool
+        '''
+        return bool(self._thread and self._thread.is_alive())
+
+    def subscribe(self, event, callback):
+        '''
+        Subscribe to an event.
+
+        :param event: One of EVENTS
+        :type event: str
+        :param callback: Called as callback(event, data, view)
+        :type callback: function
+        '''
+        if event not in self._subscribers:
+            raise Exception('Unknown event: %s' % event)
+        self._subscribers[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        '''
+        Unsubscribe from an event.
+        '''
+        self._subscribers[event].remove(callback)
+
+    def _publish(self, event, data, view):
+        for callback in list(self._subscribers[event]):
+            try:
+                callback(event, data, view)
+            except Exception:
+                _LOG.exception('Subscriber %s failed on event=%s', callback, event)
+
+    def refresh(self):
+        '''
+        Refresh the view, publishing events for any changes.
+
+        :return: New view
+        :rtype: ClusterView
+        '''
+        es = self.cluster.es
+        old = self.view
+        started = time.time()
+
+        health = es.cluster.health(request_timeout=self.cluster.poll_timeout)
+        state = es.cluster.state(metric='version,master_node,nodes', request_timeout=self.cluster.poll_timeout)
+        node_ids = set(state.get('nodes', {}))
+
+        nodes = dict((i, n) for i, n in old.nodes.items() if i in node_ids)
+        stats_at = dict((i, t) for i, t in old.stats_at.items() if i in node_ids)
+        joined = node_ids - set(nodes)
+        if joined:
+            for node in Node.iter_nodes(self.cluster, node_ids=joined):
+                nodes[node.node_id] = node
+                stats_at[node.node_id] = started
+
+        # Uptime and heap keep changing: re-read them for nodes lacking them (eg not reported right after a join)
+        # or read too long ago
+        stale = [i for i, n in nodes.items() if i not in joined and (
+                 not n.uptime or started - stats_at.get(i, 0) > self.stats_max_age)]
+        if stale:
+            stats = es.nodes.stats(node_id=','.join(sorted(stale)), metric='jvm',
+                                   request_timeout=self.cluster.poll_timeout)['nodes']
+            for node_id in stale:
+                if stats.get(node_id):
+                    nodes[node_id] = nodes[node_id].with_stats(stats[node_id])
+                    stats_at[node_id] = started
+
+        if not joined and not stale and len(nodes) == len(old.nodes):
+            # Unchanged, so _publish_changes can skip comparing nodes
+            nodes = old.nodes
+
+        view = ClusterView(version=state['version'], master_node=state.get('master_node'), nodes=nodes,
+                           stats_at=stats_at, health=health)
+        # When the data was asked for, so a view refreshed after some event really reflects the cluster after it
+        view.refreshed_at = started
+
+        with self._cond:
+            self.view = view
+            self._cond.notify_all()
+
+        if old.version is not None:
+            self._publish_changes(old, view)
+        return view
+
+    def _publish_changes(self, old, new):
+        if new.nodes is not old.nodes:
+            for node_id, node in old.nodes.items():
+                cur = new.nodes.get(node_id)
+                # A restart that kept its node id shows up as a drop in uptime
+                if not cur or (cur.uptime and node.uptime and cur.uptime < node.uptime):
+                    _LOG.info('Node left: %s', node)
+                    self._publish(EVENT_NODE_LEFT, node, new)
+            for node_id, node in new.nodes.items():
+                prev = old.nodes.get(node_id)
+                if not prev or (node.uptime and prev.uptime and node.uptime < prev.uptime):
+                    _LOG.info('Node joined: %s', node)
+                    self._publish(EVENT_NODE_JOINED, node, new)
+
+        if new.master_node != old.master_node:
+            _LOG.info('Elected master changed: %s -> %s', old.master_node, new.master_node)
+            self._publish(EVENT_MASTER_CHANGED, new.master_node, new)
+
+        if new.status != old.status:
+            _LOG.info('Cluster health changed: %s -> %s', old.status, new.status)
+            self._publish(EVENT_HEALTH_CHANGED, (old.status, new.status), new)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Expected while the node we talk to is restarting; keep the last view
+                _LOG.warning('Failed to refresh cluster view: %r', e)
+
+    def start(self):
+        '''
+        Populate the view and start refreshing it in the background.
+        '''
+        if self.running:
+            return
+        self._stop.clear()
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='watcher-%s' % self.cluster.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop refreshing.
+        '''
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def wait_for(self, predicate, timeout=None, fresh_after=None):
+        '''
+        Block until predicate(view) returns something truthy, re-evaluating on each refresh.
+
+        :param predicate: Called with the current ClusterView
+        :type predicate: function
+        :param timeout: Seconds to wait. None to wait forever.
+        :type timeout: float
+        :param fresh_after: Only consider views refreshed after this time, eg the start of the wait. Failed
+                            refreshes keep the last view, which may predate whatever is being waited on.
+        :type fresh_after: float
+        :return: Predicate's return value, or None on timeout
+        '''
+        deadline = timeout is not None and time.time() + timeout or None
+        with self._cond:
+            while True:
+                if fresh_after is None or self.view.refreshed_at > fresh_after:
+                    ret = predicate(self.view)
+                    if ret:
+                        return ret
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                # Wake up at least every few intervals in case the watcher died
+                self._cond.wait(min(remaining or self.interval * 5, self.interval * 5))
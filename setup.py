@@ -23,10 +23,15 @@ conf = dict(
     },
 
     install_requires=[
-        'elasticsearch',
+        # 8.x dropped the urllib3 connection classes and the transport API used by el_rollastico.client
+        'elasticsearch<8',
         'click',
     ],
     extras_require={
+        # --inventory
+        'inventory': [
+            'PyYAML',
+        ],
         # 'salt': [
         #    'salt',
         # ],